@@ -0,0 +1,61 @@
+import threading
+from response import status_lines
+
+"""
+Admission control: which accepted connections are served. Under overload,
+new clients get a quick 503 instead of waiting in an unbounded queue
+behind the ones that are served, which keeps the latency of those low.
+"""
+
+#the whole response to a refused connection
+overloaded = status_lines[503] + b"Retry-After:1\r\nContent-Length:0\r\nConnection:close\r\n\r\n"
+
+
+class Admission:
+    """
+    Counts the open connections of a process, in total and by client
+    address. A connection is admitted if fewer than max_connections are
+    open, and fewer than per_client from its address (0 for no limit).
+    Refusals are counted in metrics.
+    """
+
+    def __init__(self, max_connections:int = 0, per_client:int = 0, metrics = None):
+        self.max_connections = max_connections
+        self.per_client = per_client
+        self.metrics = metrics
+        self.lock = threading.Lock()
+        self.open = 0
+        self.clients = {}       #address -> open connections
+
+    def admit(self, address:str):
+        """Return True and count the connection if it is admitted, otherwise False."""
+
+        with self.lock:
+            count = self.clients.get(address, 0)
+            if ((self.max_connections and self.open >= self.max_connections)
+                    or (self.per_client and count >= self.per_client)):
+                admitted = False
+            else:
+                self.open += 1
+                self.clients[address] = count + 1
+                admitted = True
+
+        if not admitted:
+            self.refused()
+        return admitted
+
+    def release(self, address:str):
+        """Count an admitted connection as closed."""
+
+        with self.lock:
+            self.open -= 1
+            if self.clients[address] == 1:
+                del self.clients[address]
+            else:
+                self.clients[address] -= 1
+
+    def refused(self):
+        """Count a connection that is refused, here or because the server is too busy."""
+
+        if self.metrics is not None:
+            self.metrics.connection_refused()
@@ -0,0 +1,423 @@
+import asyncio
+import os
+import signal
+import time
+import servers
+from collections import deque
+from io import BytesIO
+from tempfile import SpooledTemporaryFile
+from admission import overloaded
+from httpparser import ParseError
+from response import status_lines
+from server import HTTPRouter
+
+"""
+asyncio engine for the server. One HTTPProtocol instance per connection
+parses the requests from the bytes it receives and hands them to the same
+routing logic as MyTCPHandler, so an idle keep-alive connection only costs
+a small object instead of a blocked thread.
+"""
+
+
+class HTTPProtocol(HTTPRouter, asyncio.Protocol):
+    """Parses requests from a connection and routes them with HTTPRouter."""
+
+    max_spool = 1 << 20     #bytes of a body kept in memory, the rest goes to a temporary file
+    file_chunk = 1 << 16    #bytes of a file read at a time while it is sent
+    connections = set()     #the open connections, to drain them
+
+    def __init__(self):
+        self.transport = None
+        self.timer = None
+        self.parser = self.new_parser()
+        self.request = None     #the request while its body arrives
+        self.body = None
+        self.limit = None       #bytes the body of the request may have, None if its route streams it
+        self.waiting = False    #True while a long poll or an event stream holds the connection
+        self.cancel_wait = None
+        self.end_wait = None    #answers a long poll now
+        self.admitted = False
+        self.deadline = None    #timer of the header or body deadline of the request that arrives
+        self.pending = deque()  #what waits for a file to be sent, in order: bytes, or [fd, offset, count]
+        self.paused = False     #True while the transport has more than it wants to buffer
+        self.closing = False    #close when pending is sent
+
+    def connection_made(self, transport):
+        self.peer = (transport.get_extra_info("peername") or ("-",))[0]
+        if not self.admission.admit(self.peer):
+            transport.write(overloaded)
+            transport.close()
+            return
+
+        self.admitted = True
+        self.connections.add(self)
+        self.transport = transport
+        self.metrics.connection_opened()
+        self.reset_timer()
+
+    def connection_lost(self, exc):
+        if not self.admitted:
+            return
+        self.admission.release(self.peer)
+        self.connections.discard(self)
+        self.metrics.connection_closed()
+        self.transport = None
+        if self.timer is not None:
+            self.timer.cancel()
+        self.set_deadline(None)
+        if self.cancel_wait is not None:
+            self.cancel_wait()
+            self.cancel_wait = self.end_wait = None
+        if self.body is not None:
+            self.body.close()
+        for item in self.pending:
+            if type(item) is list:
+                os.close(item[0])
+        self.pending.clear()
+
+    def pause_writing(self):
+        #the client does not read its responses, stop reading its requests
+        self.paused = True
+        if self.transport is not None:
+            self.transport.pause_reading()
+
+    def resume_writing(self):
+        self.paused = False
+        if self.transport is None:
+            return
+        if self.pending:
+            #the client reads a file, it is not idle
+            self.reset_timer()
+            self.pump()
+            if not self.pending:
+                if self.closing:
+                    self.transport.close()
+                    self.transport = None
+                else:
+                    self.resume()
+                return
+        self.update_reading()
+
+    def update_reading(self):
+        """
+        Read from the client only while what it sends is handled: not while
+        it does not read its responses, and not more than max_head bytes
+        ahead while a long poll, an event stream or a file being sent holds
+        the requests after it, so the buffer of the parser stays bounded.
+        """
+
+        if self.transport is None:
+            return
+        if self.paused or ((self.waiting or self.pending) and len(self.parser.buffer) > self.max_head):
+            self.transport.pause_reading()
+        else:
+            self.transport.resume_reading()
+
+    def reset_timer(self):
+        """Close the connection if it stays idle for keep_alive_timeout seconds."""
+
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if not self.waiting:
+            loop = asyncio.get_running_loop()
+            self.timer = loop.call_later(self.keep_alive_timeout, self.idle)
+
+    def idle(self):
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+
+    def set_deadline(self, timeout:float):
+        """Answer with 408 and close if the current head or body has not arrived in timeout seconds."""
+
+        if self.deadline is not None:
+            self.deadline.cancel()
+            self.deadline = None
+        if timeout is not None:
+            self.deadline = asyncio.get_running_loop().call_later(timeout, self.expired)
+
+    def expired(self):
+        self.deadline = None
+        if self.transport is not None:
+            self.reject(status_lines[408])
+            self.finish()
+
+    def drain(self):
+        """Answer a long poll now, and close the connection if it is between requests or holds an event stream."""
+
+        if self.end_wait is not None:
+            self.end_wait()
+        elif (self.transport is not None and self.request is None and not self.parser.buffer
+              and not self.pending):
+            self.transport.close()
+            self.transport = None
+
+    def data_received(self, data:bytes):
+        if self.transport is None:
+            return
+        self.parser.feed(data)
+        self.reset_timer()
+        self.resume()
+
+    def resume(self):
+        try:
+            self.process()
+        except ParseError as error:
+            self.set_deadline(None)
+            self.reject(error.status)
+            self.finish()
+        self.update_reading()
+
+    def finish(self):
+        """Close the connection after a response, unless it is kept alive or the response goes on."""
+
+        if self.transport is not None and not self.waiting and (self.draining or not self.keep_alive):
+            if self.pending:
+                self.closing = True
+            else:
+                self.transport.close()
+                self.transport = None
+
+    def process(self):
+        """
+        Route every request that has arrived completely. The body of a
+        request is spooled while it arrives, to disk if it is large, so
+        an upload is never all in memory. Pipelined requests are answered
+        in order, one after the other, once the file of the one before is
+        sent.
+        """
+
+        while self.transport is not None and not self.waiting and not self.pending:
+            if self.request is None:
+                request = self.parser.next_request()
+                if request is None:
+                    if self.parser.buffer and self.deadline is None:
+                        self.set_deadline(self.header_timeout)
+                    return
+
+                self.set_deadline(self.body_timeout if request.chunked or request.length else None)
+                self.request = request
+                self.headers = request.headers
+                self.head_size = request.size
+                self.start_request(request.version, self.headers.get(b"connection", b""))
+                route = self.match(request.method, request.uri)[1]
+                self.limit = None if route is not None and route.stream else self.max_body
+                if request.chunked or request.length:
+                    self.body = SpooledTemporaryFile(self.max_spool)
+                else:
+                    self.body = BytesIO()
+
+            data = self.parser.read_body(1 << 16)
+            while data:
+                self.body.write(data)
+                data = self.parser.read_body(1 << 16)
+
+            #a body that is read into memory is refused as soon as it is too large, not once it is spooled
+            if self.limit is not None and max(self.request.length or 0, self.body.tell()) > self.limit:
+                self.set_deadline(None)
+                self.body.close()
+                self.request = self.body = None
+                self.reject(status_lines[413])
+                self.finish()
+                return
+
+            if not self.parser.body_done:
+                return
+
+            self.set_deadline(None)
+            request, body = self.request, self.body
+            self.request = self.body = None
+            body.seek(0)
+            with body:
+                self.route(request.method, request.uri, body)
+            self.finish()
+
+    def wait_for_change(self, since:int, timeout:float, then):
+        """
+        Call then() when the store version is no longer since, or after
+        timeout seconds, without blocking the event loop. The requests
+        after this one wait until it is answered.
+        """
+
+        if self.store.refresh() != since:
+            then()
+            return
+
+        loop = asyncio.get_running_loop()
+
+        def wake():     #called by the store, from any thread
+            loop.call_soon_threadsafe(check)
+
+        def check(timed_out:bool = False):
+            if self.cancel_wait is None or not (timed_out or self.store.version != since):
+                return
+            self.cancel_wait()
+            self.cancel_wait = self.end_wait = None
+            self.waiting = False
+            then()
+            self.finish()
+            self.reset_timer()
+            self.resume()
+
+        self.waiting = True
+        self.reset_timer()
+        self.events.subscribe(wake)
+        deadline = loop.call_later(timeout, check, True)
+
+        def cancel():
+            self.events.unsubscribe(wake)
+            deadline.cancel()
+        self.cancel_wait = cancel
+        self.end_wait = lambda: check(True)
+
+    def stream_events(self, head:bytes, since:int):
+        """
+        Send head, then the events after since as they happen, until the
+        client goes away. A client that does not read them is disconnected.
+        """
+
+        loop = asyncio.get_running_loop()
+        self.waiting = True
+        self.reset_timer()
+        self.transport.write(head)
+
+        def flush():
+            nonlocal since
+            if self.transport is None:
+                return
+            if self.transport.get_write_buffer_size() > self.max_spool:
+                self.transport.abort()
+                return
+            events = self.events.since(since)
+            if events:
+                data = b"".join(x.encode() for x in events)
+                self.bytes_sent += len(data)
+                self.transport.write(data)
+                since = events[-1].version
+
+        def wake():     #called by the store, from any thread
+            loop.call_soon_threadsafe(flush)
+
+        def beat():
+            nonlocal ticker
+            if self.transport is not None:
+                self.transport.write(b":\n\n")
+                ticker = loop.call_later(self.heartbeat, beat)
+
+        ticker = loop.call_later(self.heartbeat, beat)
+        self.events.subscribe(wake)
+
+        def cancel():
+            self.events.unsubscribe(wake)
+            ticker.cancel()
+        self.cancel_wait = cancel
+        flush()
+
+    def send_parts(self, parts):
+        """Hand the parts to the transport without joining them."""
+
+        if self.pending:
+            self.pending.extend(parts)
+        elif self.transport is not None:
+            self.transport.writelines(parts)
+
+    def send_stream(self, chunks):
+        """Hand every chunk to the transport."""
+
+        for parts in chunks:
+            self.send_parts(parts)
+
+    def send(self, data:bytes):
+        """Write the response, or a part of it, to the transport. finish() closes the connection after."""
+
+        if self.pending:
+            self.pending.append(data)
+        elif self.transport is not None:
+            self.transport.write(data)
+
+    def send_file(self, file, offset:int, count:int):
+        """
+        Send count bytes of file from offset, a chunk at a time while the
+        transport takes them, so a big file is never all in memory. What is
+        sent after it waits in pending until it is done.
+        """
+
+        if self.transport is not None and count:
+            self.pending.append([os.dup(file.fileno()), offset, count])
+            self.pump()
+
+    def pump(self):
+        """Write what is pending to the transport, until it is all written or the transport is full."""
+
+        while self.pending and not self.paused and self.transport is not None:
+            item = self.pending[0]
+            if type(item) is not list:
+                self.pending.popleft()
+                self.transport.write(item)
+                continue
+
+            fd, offset, count = item
+            data = os.pread(fd, min(count, self.file_chunk), offset)
+            if not data:
+                #the file got shorter than the Content-Length that was sent
+                self.transport.abort()
+                self.transport = None
+                return
+            item[1] += len(data)
+            item[2] -= len(data)
+            if not item[2]:
+                os.close(fd)
+                self.pending.popleft()
+            self.transport.write(data)
+
+
+async def serve(address, backlog:int = 1024, sock = None):
+    """
+    Serve until SIGINT or SIGTERM, then drain: stop accepting, close the
+    idle connections and give the others servers.drain_timeout seconds.
+    SIGHUP hands the listening socket to a new process (servers.reload).
+    """
+
+    loop = asyncio.get_running_loop()
+    if sock is None:
+        server = await loop.create_server(HTTPProtocol, *address, reuse_address=True,
+                                          backlog=backlog)
+    else:
+        server = await loop.create_server(HTTPProtocol, sock=sock, backlog=backlog)
+    print("Serving at: http://{}:{}".format(*address))
+    servers.signal_ready()
+
+    received = asyncio.Queue()
+    for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP):
+        loop.add_signal_handler(signum, received.put_nowait, signum)
+
+    while True:
+        signum = await received.get()
+        if signum != signal.SIGHUP:
+            break
+        if await loop.run_in_executor(None, servers.reload, server.sockets):
+            break
+
+    server.close()
+    HTTPProtocol.draining = True
+    for protocol in list(HTTPProtocol.connections):
+        protocol.drain()
+    deadline = time.monotonic() + servers.drain_timeout
+    while HTTPProtocol.connections and time.monotonic() < deadline:
+        await asyncio.sleep(0.1)
+    HTTPProtocol.stopped()
+
+
+def run(address, use_uvloop:bool = False, backlog:int = 1024):
+    """Run the asyncio engine until interrupted, on uvloop if asked for and installed."""
+
+    if use_uvloop:
+        try:
+            import uvloop
+            uvloop.install()
+        except ImportError:
+            print("uvloop is not installed, using the default event loop")
+
+    sockets = servers.inherited_sockets()
+    asyncio.run(serve(address, backlog, sockets[0] if sockets else None))
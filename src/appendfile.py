@@ -0,0 +1,99 @@
+import os
+import shutil
+import threading
+from tempfile import SpooledTemporaryFile
+
+"""
+Append-only files that are answered with their content, like test.txt.
+"""
+
+
+class AppendFile:
+    """
+    A file that requests append to. The length of the file and its last
+    tail_size bytes are kept in memory, so answering with the file does not
+    read it back: the tail is sent from memory, and the rest with sendfile
+    from file, which is kept open for reading.
+
+    Like the message log, the file may be appended to by other processes,
+    or removed. That is noticed by its stat, and the length and tail are
+    read again.
+    """
+
+    max_spool = 1 << 20     #bytes of a body kept in memory while it arrives, the rest goes to a temporary file
+
+    def __init__(self, path:str, tail_size:int = 1 << 16):
+        self.path = path
+        self.tail_size = tail_size
+        self.lock = threading.Lock()
+        self.file = None        #open for reading, for sendfile
+        self.stat = None        #(inode, size) of the file when it was last seen
+        self.length = 0
+        self.tail = b""         #the last tail_size bytes of the file
+
+    def refresh(self):
+        """Catch up with the file if it was changed behind our back. Call it with the lock held."""
+
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            self.file, self.stat, self.length, self.tail = None, None, 0, b""
+            return
+
+        if self.stat == (st.st_ino, st.st_size):
+            return
+
+        if self.stat is None or self.stat[0] != st.st_ino:
+            #an old file is closed when the last response that sends from it lets go of it
+            self.file = open(self.path, "rb")
+
+        self.length = st.st_size
+        start = max(0, self.length - self.tail_size)
+        self.tail = os.pread(self.file.fileno(), self.length - start, start)
+        self.stat = (st.st_ino, st.st_size)
+
+    def append(self, body):
+        """
+        Append body, a readable stream, to the file piece by piece. The body
+        is spooled first, so a slow client does not hold the lock while it
+        sends, and a body that does not arrive completely is not appended.
+        """
+
+        with SpooledTemporaryFile(self.max_spool) as spool:
+            shutil.copyfileobj(body, spool, 1 << 16)
+            spool.seek(0)
+            self.append_spooled(spool)
+
+    def append_spooled(self, spool):
+        with self.lock:
+            self.refresh()
+            written = 0
+            tail = self.tail
+            with open(self.path, "ab") as out:
+                while True:
+                    data = spool.read(1 << 16)
+                    if not data:
+                        break
+                    out.write(data)
+                    written += len(data)
+                    tail = (tail + data)[-self.tail_size:]
+                out.flush()
+                st = os.fstat(out.fileno())
+
+            if self.stat is not None and (st.st_ino, st.st_size) == (self.stat[0], self.length + written):
+                self.length += written
+                self.tail = tail
+                self.stat = (st.st_ino, st.st_size)
+            else:
+                #created, or someone else appended too
+                self.refresh()
+
+    def snapshot(self):
+        """
+        Return the length, the tail and the open file. The file may grow
+        after, but the first length bytes of it stay the same.
+        """
+
+        with self.lock:
+            self.refresh()
+            return self.length, self.tail, self.file
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import math
+import os
+import queue
+import random
+import subprocess
+import sys
+import threading
+import time
+from http.client import HTTPConnection
+
+"""
+Load generator for the server, built from the scenarios in test_client.py.
+It runs them from many connections at once and reports the throughput
+and latency percentiles of every endpoint as JSON, so server modes and
+changes can be compared.
+
+closed - every worker starts its next scenario as soon as the last is done
+open   - scenarios start at a fixed rate, whether the server keeps up or
+         not. Latency is counted from when a scenario was due, so a server
+         that falls behind can not hide its queueing delay.
+
+Example, against a server started by the benchmark:
+    python src/bench.py --spawn "--mode threaded" --concurrency 32 --duration 10
+"""
+
+HEADERS = {
+    "Content-type": "application/x-www-form-urlencoded",
+    "Accept": "text/plain",
+}
+
+
+class Recorder:
+    """Collects the latencies and errors of every endpoint."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+
+    def add(self, endpoint:str, seconds:float, ok:bool):
+        with self.lock:
+            self.latencies.setdefault(endpoint, []).append(seconds)
+            if not ok:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+    def report(self, duration:float):
+        result = {}
+        for endpoint, latencies in sorted(self.latencies.items()):
+            latencies.sort()
+            result[endpoint] = {
+                "requests": len(latencies),
+                "errors": self.errors.get(endpoint, 0),
+                "throughput": round(len(latencies) / duration, 1),
+                "p50_ms": percentile(latencies, 50),
+                "p99_ms": percentile(latencies, 99),
+                "p999_ms": percentile(latencies, 99.9),
+                "max_ms": round(latencies[-1] * 1000, 3),
+            }
+        return result
+
+
+def percentile(sorted_latencies:list, p:float):
+    """Nearest-rank percentile in milliseconds."""
+
+    index = max(0, min(len(sorted_latencies) - 1,
+                       math.ceil(p * len(sorted_latencies) / 100) - 1))
+    return round(sorted_latencies[index] * 1000, 3)
+
+
+class Client:
+    """One keep-alive connection to the server, reopened if the server closes it."""
+
+    def __init__(self, host:str, port:int, recorder:Recorder):
+        self.connection = HTTPConnection(host, port, timeout=30)
+        self.recorder = recorder
+
+    def request(self, endpoint:str, method:str, url:str, body:bytes = None,
+                expected = (200,), start:float = None):
+        """Do one request and record it. start is when it was due, for open loop."""
+
+        headers = dict(HEADERS, **{"Content-Length": len(body)}) if body is not None else {}
+        if start is None:
+            start = time.perf_counter()
+        try:
+            self.connection.request(method, url, body=body, headers=headers)
+            response = self.connection.getresponse()
+            data = response.read()
+            ok = response.status in expected
+            if response.will_close:
+                self.connection.close()
+        except (OSError, ValueError):
+            self.connection.close()
+            data, ok = b"", False
+
+        self.recorder.add(endpoint, time.perf_counter() - start, ok)
+        return data if ok else None
+
+    def close(self):
+        self.connection.close()
+
+
+def scenario_index(client:Client, start:float = None):
+    """GET-request to root returns 'index.html'."""
+    client.request("GET /", "GET", "/", start=start)
+
+
+def scenario_test_file(client:Client, start:float = None):
+    """POST to test-file appends to the file and returns its content."""
+    client.request("POST /test.txt", "POST", "/test.txt", b"text=Simple test", start=start)
+
+
+def scenario_messages(client:Client, start:float = None):
+    """POST, PUT, GET and DELETE of one message."""
+    created = client.request("POST /messages", "POST", "/messages",
+                             b'{"text": "Benchmark message"}', expected=(201,), start=start)
+    client.request("GET /messages", "GET", "/messages")
+    if created is None:
+        return
+
+    try:
+        id = json.loads(created.lstrip(b","))["id"]
+    except (ValueError, KeyError, TypeError):
+        return
+    #the id in the body, like the RESTful tests in test_client.py
+    client.request("PUT /messages", "PUT", "/messages",
+                   b'{"id": %d,"text": "Replaced benchmark message"}' % id)
+    client.request("DELETE /messages", "DELETE", "/messages", b'{"id": %d}' % id)
+
+
+scenarios = {
+    "index": scenario_index,
+    "test": scenario_test_file,
+    "messages": scenario_messages,
+}
+
+
+def run_closed(args, recorder:Recorder, chosen:list):
+    """Every worker runs scenarios back to back until the time is up."""
+
+    deadline = time.perf_counter() + args.duration
+
+    def worker():
+        client = Client(args.host, args.port, recorder)
+        while time.perf_counter() < deadline:
+            random.choice(chosen)(client)
+        client.close()
+
+    threads = [threading.Thread(target=worker) for _ in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def run_open(args, recorder:Recorder, chosen:list):
+    """Scenarios are due at a fixed rate, and run by the first free worker."""
+
+    due = queue.Queue()
+
+    def worker():
+        client = Client(args.host, args.port, recorder)
+        while True:
+            start = due.get()
+            if start is None:
+                break
+            random.choice(chosen)(client, start)
+        client.close()
+
+    threads = [threading.Thread(target=worker) for _ in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+
+    begin = time.perf_counter()
+    total = int(args.rate * args.duration)
+    for i in range(total):
+        start = begin + i / args.rate
+        delay = start - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        due.put(start)
+
+    for _ in threads:
+        due.put(None)
+    for thread in threads:
+        thread.join()
+
+
+def wait_for_server(host:str, port:int, timeout:float = 10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            connection = HTTPConnection(host, port, timeout=1)
+            connection.request("GET", "/")
+            connection.getresponse().read()
+            connection.close()
+            return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the INF-2300 http server")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--scenarios", default=",".join(scenarios),
+                        help="comma separated scenarios to mix: " + ", ".join(scenarios))
+    parser.add_argument("--loop", choices=("closed", "open"), default="closed")
+    parser.add_argument("--concurrency", type=int, default=16,
+                        help="connections, each driven by its own thread")
+    parser.add_argument("--rate", type=float, default=500,
+                        help="scenarios started per second, in open loop")
+    parser.add_argument("--duration", type=float, default=10, help="seconds to run")
+    parser.add_argument("--spawn", metavar="ARGS",
+                        help="start src/server.py with these arguments for the benchmark")
+    parser.add_argument("--output", help="write the JSON report to this file")
+    args = parser.parse_args()
+
+    try:
+        chosen = [scenarios[x] for x in args.scenarios.split(",")]
+    except KeyError as error:
+        parser.error("unknown scenario " + str(error))
+
+    server = None
+    if args.spawn is not None:
+        command = [sys.executable, os.path.join(os.path.dirname(__file__), "server.py"),
+                   "--host", args.host, "--port", str(args.port)] + args.spawn.split()
+        server = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+
+    try:
+        if not wait_for_server(args.host, args.port):
+            sys.exit("the server at {}:{} does not answer".format(args.host, args.port))
+
+        recorder = Recorder()
+        begin = time.perf_counter()
+        if args.loop == "open":
+            run_open(args, recorder, chosen)
+        else:
+            run_closed(args, recorder, chosen)
+        duration = time.perf_counter() - begin
+
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    report = {
+        "loop": args.loop,
+        "concurrency": args.concurrency,
+        "rate": args.rate if args.loop == "open" else None,
+        "duration": round(duration, 3),
+        "server": args.spawn,
+        "endpoints": recorder.report(duration),
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(text + "\n")
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+import threading
+from collections import OrderedDict
+
+"""
+Read-through cache of whole responses to GET requests, so a request for
+something that did not change is answered without going to its handler.
+"""
+
+
+class ResponseCache:
+    """
+    An LRU cache of at most max_bytes of responses, by key. A response is
+    kept with the version of the resource it was made from, and only used
+    while the version is the same, so a change of the resource makes the
+    responses to it stale without having to find them.
+    """
+
+    def __init__(self, max_bytes:int = 8 << 20):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()    #key -> (version, status, header, body)
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, key:tuple, version):
+        """Return (version, status, header, body) kept for key at version, or None."""
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] != version:
+                self.remove(key)
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key:tuple, version, status:bytes, header:bytes, body:bytes):
+        size = len(header) + len(body)
+        if size > self.max_bytes:
+            return
+
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = (version, status, header, body)
+            self.size += size
+            while self.size > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+
+    def remove(self, key:tuple):
+        _, _, header, body = self.entries.pop(key)
+        self.size -= len(header) + len(body)
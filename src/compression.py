@@ -0,0 +1,104 @@
+import gzip
+import threading
+from collections import OrderedDict
+
+try:
+    import brotli
+except ImportError:     #brotli is optional
+    brotli = None
+
+"""
+Compression of response bodies, negotiated with Accept-Encoding. The
+compressed variants are cached by resource and etag, so a body is only
+compressed once for every version of it.
+"""
+
+compressible_types = (b"text/", b"application/json", b"application/javascript",
+                      b"application/xml", b"image/svg+xml")
+
+
+def parse_accept_encoding(header:bytes):
+    """Return a dict of the encodings in an Accept-Encoding header and their q-values."""
+
+    accepted = {}
+    for item in header.lower().split(b","):
+        name, _, params = item.strip().partition(b";")
+        if not name:
+            continue
+
+        q = 1.0
+        params = params.strip()
+        if params.startswith(b"q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[name.strip()] = q
+
+    return accepted
+
+
+class Compressor:
+    """
+    Picks an encoding for a response and compresses bodies into an LRU
+    cache of at most max_bytes. Bodies shorter than min_size are never
+    compressed, it does not pay off.
+    """
+
+    def __init__(self, min_size:int = 1024, max_bytes:int = 8 << 20,
+                 gzip_level:int = 6, brotli_quality:int = 5):
+        self.min_size = min_size
+        self.max_bytes = max_bytes
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.encodings = (b"br", b"gzip") if brotli is not None else (b"gzip",)
+
+        self.cache = OrderedDict()  #(resource, etag, encoding) -> compressed body
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def compressible(self, type:bytes, size:int):
+        """Return True if a body of this type and size is worth compressing."""
+
+        return size >= self.min_size and type.lower().startswith(compressible_types)
+
+    def negotiate(self, accept_encoding:bytes):
+        """Return the best encoding the client accepts, or None for no compression."""
+
+        if not accept_encoding:
+            return None
+
+        accepted = parse_accept_encoding(accept_encoding)
+        wildcard = accepted.get(b"*", 0.0)
+        best, best_q = None, 0.0
+        for encoding in self.encodings:
+            q = accepted.get(encoding, wildcard)
+            if q > best_q:
+                best, best_q = encoding, q
+
+        return best
+
+    def compress(self, resource:bytes, etag:bytes, encoding:bytes, body:bytes):
+        """Return body compressed with encoding, from the cache if this version was compressed before."""
+
+        key = (resource, etag, encoding)
+        with self.lock:
+            cached = self.cache.get(key)
+            if cached is not None:
+                self.cache.move_to_end(key)
+                return cached
+
+        if encoding == b"br":
+            compressed = brotli.compress(body, quality=self.brotli_quality)
+        else:
+            compressed = gzip.compress(body, self.gzip_level, mtime=0)
+
+        with self.lock:
+            if key not in self.cache and len(compressed) <= self.max_bytes:
+                self.cache[key] = compressed
+                self.size += len(compressed)
+                while self.size > self.max_bytes:
+                    _, old = self.cache.popitem(last=False)
+                    self.size -= len(old)
+
+        return compressed
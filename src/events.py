@@ -0,0 +1,100 @@
+import threading
+from collections import deque
+
+"""
+Change events of the message store, for the subscribers of
+/messages/events and for long-polling GET /messages?wait=.
+"""
+
+
+class Event:
+    """A change of the messages. record is None for a delete and a reset."""
+
+    __slots__ = ("version", "type", "id", "record")
+
+    def __init__(self, version:int, type:bytes, id:int, record:bytes):
+        self.version = version
+        self.type = type
+        self.id = id
+        self.record = record
+
+    def encode(self):
+        """Return the event in the text/event-stream format."""
+
+        if self.type == b"reset":
+            data = b""
+        elif self.record is None:
+            data = b'{"id": %d}' % self.id
+        else:
+            data = bytes(self.record)   #may be a slice of a mapped log
+
+        lines = b"".join(b"data: " + x + b"\n" for x in data.split(b"\n"))
+        return b"id: %d\nevent: %s\n%s\n" % (self.version, self.type, lines)
+
+
+class Events:
+    """
+    Keeps the last keep changes of a MessageStore, which publishes them
+    through its hooks. Blocking handlers wait() for a change, the asyncio
+    engine subscribes a function that is called (from any thread) when
+    there is one.
+
+    A subscriber that asks for changes older than the ones kept, or from
+    before the store was loaded, gets a reset event, after which it should
+    get the whole listing again. So does one that asks for a version ahead
+    of the store, from a log that was replaced.
+    """
+
+    def __init__(self, store, keep:int = 1024):
+        self.condition = threading.Condition()
+        self.kept = deque(maxlen=keep)
+        self.dropped = store.version    #version of the newest event that is no longer kept
+        self.version = store.version
+        self.listeners = []
+        store.hooks.append(self.publish)
+
+    def publish(self, version:int, type:bytes, id:int, record:bytes):
+        with self.condition:
+            if type == b"reset":
+                #the store was loaded again, what came before it is not known
+                self.kept.clear()
+                self.dropped = version
+            elif len(self.kept) == self.kept.maxlen:
+                self.dropped = self.kept[0].version
+            self.kept.append(Event(version, type, id, record))
+            self.version = version
+            self.condition.notify_all()
+            listeners = list(self.listeners)
+
+        for listener in listeners:
+            listener()
+
+    def since(self, version:int):
+        """Return the events after version."""
+
+        with self.condition:
+            if version < self.dropped or version > self.version:
+                return [Event(self.version, b"reset", None, None)]
+            events = []
+            for event in reversed(self.kept):
+                if event.version <= version:
+                    break
+                events.append(event)
+            events.reverse()
+            return events
+
+    def wait(self, version:int, timeout:float):
+        """Wait until there is an event after version, at most timeout seconds."""
+
+        with self.condition:
+            if self.version == version:
+                self.condition.wait(timeout)
+
+    def subscribe(self, listener):
+        with self.condition:
+            self.listeners.append(listener)
+
+    def unsubscribe(self, listener):
+        with self.condition:
+            if listener in self.listeners:
+                self.listeners.remove(listener)
@@ -0,0 +1,248 @@
+import io
+from response import status_lines
+
+"""
+Incremental HTTP/1.1 request parser. Bytes from the connection are fed in
+as they arrive, and the parser hands out request heads and body bytes as
+soon as they are complete. Everything it buffers is bounded by the limits
+it is given, and bodies (also chunked ones) are handed out in pieces, so
+they never have to be in memory all at once.
+"""
+
+
+class ParseError(Exception):
+    """The request can not be parsed. status is the status line to respond with."""
+
+    def __init__(self, status:bytes):
+        super().__init__(status)
+        self.status = status
+
+
+bad_request = status_lines[400]
+too_long = status_lines[414]
+too_large = status_lines[431]
+not_implemented = status_lines[501]
+
+max_chunk_line = 1024       #bytes of a chunk size line, with extensions
+
+
+class Request:
+    """The head of a request. headers has lowercase names, size is the bytes of the head."""
+
+    __slots__ = ("method", "uri", "version", "headers", "chunked", "length", "size")
+
+    def __init__(self, method:bytes, uri:bytes, version:bytes, headers:dict,
+                 chunked:bool, length:int, size:int = 0):
+        self.method = method
+        self.uri = uri
+        self.version = version
+        self.headers = headers
+        self.chunked = chunked
+        self.length = length
+        self.size = size
+
+
+class RequestParser:
+    """
+    Parses the requests of one connection. Call feed() with the received
+    bytes, next_request() to get the head of the next request, and
+    read_body() to get the body of that request before the next one.
+
+    max_line     - bytes of the request line
+    max_head     - bytes of the request line and headers together
+    max_headers  - number of headers
+    """
+
+    def __init__(self, max_line:int = 8190, max_head:int = 1 << 16, max_headers:int = 100):
+        self.max_line = max_line
+        self.max_head = max_head
+        self.max_headers = max_headers
+
+        self.buffer = bytearray()
+        self.state = "head"     #head, length, chunk-size, chunk-data, chunk-end or trailer
+        self.remaining = 0      #bytes left of the body or of the current chunk
+        self.trailer = 0        #bytes of trailer read
+        self.body_bytes = 0     #bytes of the body of the current request handed out
+
+    @property
+    def body_done(self):
+        """True when the body of the current request has been read."""
+
+        return self.state == "head"
+
+    def feed(self, data:bytes):
+        self.buffer += data
+
+    def next_request(self):
+        """
+        Return the next Request if its head has arrived, otherwise None.
+        Raise ParseError if it is invalid or too large.
+        """
+
+        if self.state != "head":
+            raise RuntimeError("the body of the previous request is not read")
+
+        #empty lines before a request are allowed
+        while self.buffer.startswith(b"\r\n"):
+            del self.buffer[:2]
+
+        end = self.buffer.find(b"\r\n\r\n")
+        if end == -1:
+            if self.buffer.find(b"\r\n") == -1 and len(self.buffer) > self.max_line:
+                raise ParseError(too_long)
+            if len(self.buffer) > self.max_head:
+                raise ParseError(too_large)
+            return None
+
+        if end + 4 > self.max_head:
+            raise ParseError(too_large)
+
+        lines = bytes(self.buffer[:end]).split(b"\r\n")
+        del self.buffer[:end + 4]
+        self.body_bytes = 0
+
+        if len(lines[0]) > self.max_line:
+            raise ParseError(too_long)
+        request_line = lines[0].split(b" ")
+        if len(request_line) != 3 or not request_line[2].startswith(b"HTTP/"):
+            raise ParseError(bad_request)
+        method, uri, version = request_line
+
+        if len(lines) - 1 > self.max_headers:
+            raise ParseError(too_large)
+        headers = {}
+        for line in lines[1:]:
+            name, sep, value = line.partition(b":")
+            if not sep or not name or name != name.strip():
+                raise ParseError(bad_request)   #also obsolete line folding
+            name = name.lower()
+            value = value.strip()
+            headers[name] = headers[name] + b", " + value if name in headers else value
+
+        chunked = False
+        length = 0
+        if b"transfer-encoding" in headers:
+            if b"content-length" in headers:
+                raise ParseError(bad_request)
+            if headers[b"transfer-encoding"].lower().split(b",")[-1].strip() != b"chunked":
+                raise ParseError(not_implemented)
+            chunked = True
+            self.state = "chunk-size"
+
+        elif b"content-length" in headers:
+            if not headers[b"content-length"].isdigit():
+                raise ParseError(bad_request)
+            length = int(headers[b"content-length"])
+            if length:
+                self.state = "length"
+                self.remaining = length
+
+        return Request(method, uri, version, headers, chunked, length, end + 4)
+
+    def read_body(self, size:int = -1):
+        """
+        Return up to size bytes (any amount if size is negative) of the body
+        that have arrived. b"" means that more bytes are needed, or that the
+        body is done if body_done is True. Raise ParseError if a chunked body
+        is invalid.
+        """
+
+        out = bytearray()
+        while size < 0 or len(out) < size:
+            if self.state in ("length", "chunk-data"):
+                n = min(self.remaining, len(self.buffer))
+                if size >= 0:
+                    n = min(n, size - len(out))
+                if n == 0:
+                    break
+
+                out += self.buffer[:n]
+                del self.buffer[:n]
+                self.remaining -= n
+                if self.remaining == 0:
+                    self.state = "head" if self.state == "length" else "chunk-end"
+
+            elif self.state == "chunk-size":
+                end = self.buffer.find(b"\r\n")
+                if end == -1:
+                    if len(self.buffer) > max_chunk_line:
+                        raise ParseError(bad_request)
+                    break
+
+                line = bytes(self.buffer[:end]).split(b";", 1)[0].strip()
+                del self.buffer[:end + 2]
+                try:
+                    self.remaining = int(line, 16)
+                except ValueError:
+                    raise ParseError(bad_request)
+                if self.remaining < 0:
+                    raise ParseError(bad_request)
+
+                if self.remaining == 0:
+                    self.state = "trailer"
+                    self.trailer = 0
+                else:
+                    self.state = "chunk-data"
+
+            elif self.state == "chunk-end":
+                if len(self.buffer) < 2:
+                    break
+                if self.buffer[:2] != b"\r\n":
+                    raise ParseError(bad_request)
+                del self.buffer[:2]
+                self.state = "chunk-size"
+
+            elif self.state == "trailer":
+                #the trailer fields are read and ignored
+                end = self.buffer.find(b"\r\n")
+                if end == -1:
+                    if self.trailer + len(self.buffer) > self.max_head:
+                        raise ParseError(too_large)
+                    break
+
+                self.trailer += end + 2
+                del self.buffer[:end + 2]
+                if end == 0:
+                    self.state = "head"
+
+            else:
+                break
+
+        self.body_bytes += len(out)
+        return bytes(out)
+
+
+class BodyStream(io.RawIOBase):
+    """
+    The body of the current request of parser as a readable stream. When
+    the parser needs more bytes, they are read with fill, which returns
+    b"" when the connection is closed.
+    """
+
+    def __init__(self, parser:RequestParser, fill):
+        self.parser = parser
+        self.fill = fill
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while True:
+            data = self.parser.read_body(len(buffer))
+            if data:
+                buffer[:len(data)] = data
+                return len(data)
+
+            if self.parser.body_done:
+                return 0
+
+            more = self.fill()
+            if not more:
+                raise ConnectionError("connection closed in the middle of the body")
+            self.parser.feed(more)
+
+
+def body_stream(parser:RequestParser, fill):
+    """Return a buffered stream of the body of the current request of parser."""
+
+    return io.BufferedReader(BodyStream(parser, fill))
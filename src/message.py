@@ -0,0 +1,79 @@
+import json
+
+try:
+    import orjson
+except ImportError:     #orjson is optional, it parses and serializes faster
+    orjson = None
+
+"""
+The message model. A request body is parsed once into a Message, and a
+Message is serialized into the record format of the store:
+
+    {"id": <id>,"text": <text>}
+"""
+
+if orjson is not None:
+    loads = orjson.loads
+
+    def dump_text(text:str):
+        return orjson.dumps(text)
+
+else:
+    loads = json.loads
+
+    def dump_text(text:str):
+        return json.dumps(text, ensure_ascii=False).encode()
+
+
+class Message:
+    """
+    A message from a request body, or one to store. text is the text as
+    json (a quoted and escaped string), so it is only encoded once. id and
+    text are None when the body did not have them.
+    """
+
+    __slots__ = ("id", "text")
+
+    def __init__(self, id:int = None, text:bytes = None):
+        self.id = id
+        self.text = text
+
+    @classmethod
+    def parse(cls, body:bytes):
+        """
+        Return the Message in a json request body. Raise ValueError if body
+        is not a json object, or id is not an integer or text not a string.
+        """
+
+        try:
+            fields = loads(body)
+        except (ValueError, TypeError) as error:
+            raise ValueError(str(error))
+        if not isinstance(fields, dict):
+            raise ValueError("the body is not a json object")
+
+        id = fields.get("id")
+        if id is not None and (not isinstance(id, int) or isinstance(id, bool)):
+            raise ValueError("id is not an integer")
+
+        text = fields.get("text")
+        if text is not None:
+            if not isinstance(text, str):
+                raise ValueError("text is not a string")
+            text = dump_text(text)
+
+        return cls(id, text)
+
+    def record(self):
+        """Return the message in the record format of the store."""
+
+        return b'{"id": %d,"text": %s}' % (self.id, self.text)
+
+    def write(self, out:bytearray):
+        """Append the record of the message to out, a buffer that is reused."""
+
+        out += b'{"id": '
+        out += b"%d" % self.id
+        out += b',"text": '
+        out += self.text
+        out += b'}'
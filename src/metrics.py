@@ -0,0 +1,161 @@
+import math
+import os
+import threading
+
+"""
+Counters and latency histograms of the requests the server handles,
+exposed in the Prometheus text format at /metrics. Every process keeps its
+own, so in prefork mode a scrape shows the worker that answered it. Every
+series has the pid of the process as a label, so the counters of different
+workers are different series, which sum() adds up, instead of one series
+that seems to jump back and forth between scrapes.
+"""
+
+
+class Histogram:
+    """
+    Latency histogram with log-linear buckets, like HdrHistogram: every
+    power of two of microseconds is split in sub_buckets equal parts, so a
+    value is off by at most 1/sub_buckets. Recording is a frexp and an
+    increment, no search through the bounds.
+    """
+
+    def __init__(self, sub_buckets:int = 4, lowest:int = 4, highest:int = 26):
+        self.sub_buckets = sub_buckets
+        self.lowest = lowest        #values below 2**lowest microseconds share the first bucket
+        self.highest = highest      #values from 2**highest microseconds (67 s) share the last
+        self.counts = [0] * ((highest - lowest) * sub_buckets + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def bucket(self, seconds:float):
+        """Return the index of the bucket of a value."""
+
+        mantissa, exponent = math.frexp(seconds * 1e6)     #value = mantissa * 2**exponent, 0.5 <= mantissa < 1
+        if exponent <= self.lowest:
+            return 0
+        if exponent > self.highest:
+            return len(self.counts) - 1
+        return (exponent - 1 - self.lowest) * self.sub_buckets + int((mantissa * 2 - 1) * self.sub_buckets)
+
+    def record(self, seconds:float):
+        self.counts[self.bucket(seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def bounds(self):
+        """Return the upper bound in seconds of every bucket but the last."""
+
+        return [2 ** (self.lowest + i // self.sub_buckets)
+                * (1 + (i % self.sub_buckets + 1) / self.sub_buckets) / 1e6
+                for i in range(len(self.counts) - 1)]
+
+
+class Metrics:
+    """
+    The metrics of one server process. observe() is called once for every
+    response, with the method and route it was for. Routes are a small
+    fixed set of names, never the raw path, so the number of series stays
+    bounded.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}      #(method, route, status code) -> count
+        self.bytes_in = {}      #(method, route) -> bytes
+        self.bytes_out = {}     #(method, route) -> bytes
+        self.latency = {}       #(method, route) -> Histogram
+        self.connections = 0    #open connections
+        self.connections_total = 0
+        self.connections_refused = 0
+
+    def connection_opened(self):
+        with self.lock:
+            self.connections += 1
+            self.connections_total += 1
+
+    def connection_closed(self):
+        with self.lock:
+            self.connections -= 1
+
+    def connection_refused(self):
+        with self.lock:
+            self.connections_refused += 1
+
+    def observe(self, method:str, route:str, status:int, seconds:float,
+                bytes_in:int, bytes_out:int):
+        """Record a response."""
+
+        key = (method, route)
+        with self.lock:
+            self.requests[key + (status,)] = self.requests.get(key + (status,), 0) + 1
+            self.bytes_in[key] = self.bytes_in.get(key, 0) + bytes_in
+            self.bytes_out[key] = self.bytes_out.get(key, 0) + bytes_out
+            histogram = self.latency.get(key)
+            if histogram is None:
+                histogram = self.latency[key] = Histogram()
+            histogram.record(seconds)
+
+    def rejected(self, status:int):
+        """Record a response to a request that could not be parsed."""
+
+        key = ("other", "invalid", status)
+        with self.lock:
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+    def render(self, gauges:dict = None):
+        """
+        Return the metrics in the Prometheus text format. gauges are extra
+        values to include, name -> (help, value).
+        """
+
+        lines = []
+        pid = 'pid="%d"' % os.getpid()
+
+        def family(name:str, type:str, help:str):
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s %s" % (name, type))
+
+        with self.lock:
+            family("http_requests_total", "counter", "Requests answered, by route and status code.")
+            for (method, route, status), count in sorted(self.requests.items()):
+                lines.append('http_requests_total{%s,method="%s",route="%s",code="%d"} %d'
+                             % (pid, method, route, status, count))
+
+            family("http_request_bytes_total", "counter", "Bytes received in requests.")
+            for (method, route), count in sorted(self.bytes_in.items()):
+                lines.append('http_request_bytes_total{%s,method="%s",route="%s"} %d'
+                             % (pid, method, route, count))
+
+            family("http_response_bytes_total", "counter", "Bytes sent in responses.")
+            for (method, route), count in sorted(self.bytes_out.items()):
+                lines.append('http_response_bytes_total{%s,method="%s",route="%s"} %d'
+                             % (pid, method, route, count))
+
+            family("http_request_duration_seconds", "histogram",
+                   "Time from a parsed request head to the sent response.")
+            for (method, route), histogram in sorted(self.latency.items()):
+                labels = '%s,method="%s",route="%s"' % (pid, method, route)
+                cumulative = 0
+                for bound, count in zip(histogram.bounds(), histogram.counts):
+                    cumulative += count
+                    lines.append('http_request_duration_seconds_bucket{%s,le="%.6g"} %d'
+                                 % (labels, bound, cumulative))
+                lines.append('http_request_duration_seconds_bucket{%s,le="+Inf"} %d'
+                             % (labels, histogram.count))
+                lines.append("http_request_duration_seconds_sum{%s} %.6f" % (labels, histogram.sum))
+                lines.append("http_request_duration_seconds_count{%s} %d" % (labels, histogram.count))
+
+            family("http_active_connections", "gauge", "Open client connections.")
+            lines.append("http_active_connections{%s} %d" % (pid, self.connections))
+            family("http_connections_total", "counter", "Client connections accepted.")
+            lines.append("http_connections_total{%s} %d" % (pid, self.connections_total))
+            family("http_connections_refused_total", "counter",
+                   "Client connections refused with 503, because the server was too busy.")
+            lines.append("http_connections_refused_total{%s} %d" % (pid, self.connections_refused))
+
+        for name, (help, value) in (gauges or {}).items():
+            family(name, "gauge", help)
+            lines.append("%s{%s} %d" % (name, pid, value))
+
+        return ("\n".join(lines) + "\n").encode()
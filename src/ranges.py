@@ -0,0 +1,93 @@
+from email.utils import parsedate_to_datetime
+
+"""
+Byte ranges (RFC 9110, section 14): the parts of a body that the Range
+header of a request asks for, so a client can resume a download or fetch
+only the bytes it does not have yet.
+"""
+
+max_ranges = 16     #ranges in one request, a Range header with more is ignored
+
+
+class Unsatisfiable(Exception):
+    """The Range header asks for bytes that the body does not have, respond with 416."""
+
+
+def parse_ranges(header:bytes, length:int):
+    """
+    Return a list of (start, end), with end exclusive, of the bytes a Range
+    header asks for in a body of length bytes, or None to send the whole
+    body: if there is no header, or it has another unit or can not be parsed
+    (then it is ignored, like the RFC says). Overlapping and adjacent ranges
+    are merged. Raise Unsatisfiable if none of the asked bytes are in the
+    body.
+    """
+
+    if not header:
+        return None
+
+    unit, _, specs = header.partition(b"=")
+    if unit.strip().lower() != b"bytes":
+        return None
+
+    specs = [x.strip() for x in specs.split(b",") if x.strip()]
+    if not specs or len(specs) > max_ranges:
+        return None
+
+    spans = []
+    for spec in specs:
+        first, dash, last = spec.partition(b"-")
+        first, last = first.strip(), last.strip()
+        if not dash or not (first or last):
+            return None
+        if (first and not first.isdigit()) or (last and not last.isdigit()):
+            return None
+
+        if not first:
+            #a suffix, the last bytes
+            if int(last) > 0 and length > 0:
+                spans.append((max(0, length - int(last)), length))
+            continue
+
+        start = int(first)
+        if last and int(last) < start:
+            return None
+        if start < length:
+            spans.append((start, min(int(last) + 1, length) if last else length))
+
+    if not spans:
+        raise Unsatisfiable(header)
+
+    if len(spans) == 1:
+        return spans
+
+    spans.sort()
+    merged = [spans[0]]
+    for start, end in spans[1:]:
+        if start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def if_range(header:bytes, etag:bytes, modified:float):
+    """
+    Return True if the Range of a request should be honored, given its
+    If-Range header and the validators of the body. The etag has to match
+    strongly, or the date has to be exactly the last modified date.
+    """
+
+    if not header:
+        return True
+
+    if header.startswith(b'"'):
+        return etag is not None and header == etag
+
+    if header.startswith(b"W/") or modified is None:
+        return False
+
+    try:
+        return parsedate_to_datetime(header.decode()).timestamp() == int(modified)
+    except (ValueError, TypeError):
+        return False
@@ -0,0 +1,48 @@
+import os
+import threading
+import time
+from email.utils import formatdate
+from http import HTTPStatus
+
+"""
+The building blocks of a response that do not change from one response to
+the next, prepared once: the status lines, and the start of the header
+with the Date, which a timer thread renews every second.
+"""
+
+#pre-encoded status line for every status code
+status_lines = {status.value: ("HTTP/1.1 %d %s\r\n" % (status.value, status.phrase)).encode()
+                for status in HTTPStatus}
+
+
+class HeadTemplate:
+    """
+    The Date and Server headers and the start of the Content-Type header,
+    as one bytes object. It is renewed by a timer thread at the start of
+    every second, so a response only has to read it.
+    """
+
+    def __init__(self, server_name:bytes):
+        self.server_name = server_name
+        self.prefix = self.build()
+        self.pid = None
+
+    def build(self):
+        date = formatdate(time.time(), usegmt=True).encode()
+        return b"Date:" + date + b" \r\nServer:" + self.server_name + b" \r\nContent-Type:"
+
+    def get(self):
+        """Return the prefix, and start the timer thread if this process has none."""
+
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            threading.Thread(target=self.renew, daemon=True).start()
+            self.prefix = self.build()
+
+        return self.prefix
+
+    def renew(self):
+        pid = os.getpid()
+        while self.pid == pid:
+            time.sleep(1 - time.time() % 1)
+            self.prefix = self.build()
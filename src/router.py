@@ -0,0 +1,165 @@
+"""
+Request routing. Routes are registered once, with a method and a path
+pattern, where a segment in braces is a parameter ("messages/{id}") and a
+last segment "{name*}" takes the rest of the path. They are compiled into
+a dict of the paths without parameters and a trie of path segments for
+the rest, so finding the route of a request is a dict lookup per path
+segment, however many routes there are.
+
+The handler of a route is called through a pipeline of middleware, see
+pipeline().
+"""
+
+
+class Route:
+    """
+    A registered route. handler is the name of the method of the request
+    handler that answers it, so subclasses can override it. name is the
+    route in the metrics, and with stream the body is passed as a stream
+    instead of being read into memory. cache is the name of the method that
+    returns the version of the resource, if responses can be cached.
+    """
+
+    __slots__ = ("method", "pattern", "handler", "name", "stream", "cache")
+
+    def __init__(self, method:bytes, pattern:bytes, handler:str, name:str, stream:bool,
+                 cache:str = None):
+        self.method = method
+        self.pattern = pattern
+        self.handler = handler
+        self.name = name
+        self.stream = stream
+        self.cache = cache
+
+
+class Node:
+    """A node of the trie: the routes ending here by method, and the segments after it."""
+
+    __slots__ = ("routes", "children", "param", "rest")
+
+    def __init__(self):
+        self.routes = {}        #method -> Route
+        self.children = {}      #literal segment -> Node
+        self.param = None       #(name, Node) for a {name} segment
+        self.rest = None        #(name, {method -> Route}) for a {name*} segment
+
+
+class Call:
+    """A request on its way through the middleware to its handler."""
+
+    __slots__ = ("method", "uri", "path", "body", "route", "params")
+
+    def __init__(self, method:bytes, uri:bytes, path:bytes, body, route:Route, params:dict):
+        self.method = method
+        self.uri = uri
+        self.path = path
+        self.body = body
+        self.route = route
+        self.params = params
+
+
+class Router:
+    """
+    The routes of a server. Register them with add(), or with the route()
+    decorator on the methods of the request handler, then find the route
+    of a request with match().
+    """
+
+    def __init__(self):
+        self.static = {}        #(method, path) -> Route, for patterns without parameters
+        self.root = Node()
+
+    def add(self, method:bytes, pattern:bytes, handler:str, name:str = None, stream:bool = False,
+            cache:str = None):
+        route = Route(method, pattern, handler, name or "/" + pattern.decode(), stream, cache)
+        if b"{" not in pattern:
+            self.static[(method, pattern)] = route
+            return route
+
+        node = self.root
+        segments = pattern.split(b"/")
+        for i, segment in enumerate(segments):
+            if segment.startswith(b"{") and segment.endswith(b"*}"):
+                if i != len(segments) - 1:
+                    raise ValueError("{name*} must be the last segment: " + pattern.decode())
+                if node.rest is None:
+                    node.rest = (segment[1:-2].decode(), {})
+                node.rest[1][method] = route
+                return route
+
+            if segment.startswith(b"{") and segment.endswith(b"}"):
+                if node.param is None:
+                    node.param = (segment[1:-1].decode(), Node())
+                node = node.param[1]
+            else:
+                node = node.children.setdefault(segment, Node())
+
+        node.routes[method] = route
+        return route
+
+    def route(self, method:bytes, *patterns:bytes, name:str = None, stream:bool = False,
+              cache:str = None):
+        """Decorator that registers a method of the request handler for the patterns."""
+
+        def register(function):
+            for pattern in patterns:
+                self.add(method, pattern, function.__name__, name, stream, cache)
+            return function
+
+        return register
+
+    def match(self, method:bytes, path:bytes):
+        """
+        Return the Route of a request and its parameters, or (None, None).
+        Literal segments win over parameters, and parameters over {name*}.
+        """
+
+        route = self.static.get((method, path))
+        if route is not None:
+            return route, {}
+
+        params = {}
+        route = self.search(self.root, method, path.split(b"/"), 0, params)
+        return (route, params) if route is not None else (None, None)
+
+    def search(self, node:Node, method:bytes, segments:list, i:int, params:dict):
+        if i == len(segments):
+            route = node.routes.get(method)
+            if route is not None:
+                return route
+        else:
+            child = node.children.get(segments[i])
+            if child is not None:
+                route = self.search(child, method, segments, i + 1, params)
+                if route is not None:
+                    return route
+
+            if node.param is not None:
+                name, child = node.param
+                route = self.search(child, method, segments, i + 1, params)
+                if route is not None:
+                    params[name] = segments[i]
+                    return route
+
+        if node.rest is not None and method in node.rest[1]:
+            name, routes = node.rest
+            params[name] = b"/".join(segments[i:])
+            return routes[method]
+
+        return None
+
+
+def pipeline(middleware:list, endpoint):
+    """
+    Return endpoint wrapped in the middleware, the first one outermost. A
+    middleware is called as middleware(handler, call, next), with the
+    request handler and the Call, and goes on with next(handler, call).
+    The pipeline is built once, not for every request.
+    """
+
+    def wrap(middleware, inner):
+        return lambda handler, call: middleware(handler, call, inner)
+
+    for layer in reversed(middleware):
+        endpoint = wrap(layer, endpoint)
+    return endpoint
@@ -1,8 +1,28 @@
 #!/usr/bin/env python3
+import errno
+import hmac
+import os
+import select
+import socket
 import socketserver
-from datetime import datetime
-import json
+import sys
+import time
+from email.utils import formatdate, parsedate_to_datetime
+from urllib.parse import parse_qs
 from traceback import print_tb
+from store import MessageStore
+from static import StaticFiles
+from appendfile import AppendFile
+from ranges import Unsatisfiable, if_range, parse_ranges
+from compression import Compressor
+from httpparser import ParseError, RequestParser, body_stream
+from response import HeadTemplate, status_lines
+from metrics import Metrics
+from events import Events
+from cache import ResponseCache
+from admission import Admission
+from message import Message, dump_text, loads
+from router import Call, Router, pipeline
 
 """
 Written by: Raymon Skjørten Hansen
@@ -15,384 +35,1167 @@ May 9th, 2019
 server_name = b"My server"
 valid_req = [b"GET", b"OPTION", b"HEAD", b"POST", b"PUT", 
              b"DELETE", b"TRACE", b"CONNECT"]
-max_msgs = 256
+max_msgs = 0                #messages in the store, 0 for no limit
+no_space = (errno.ENOSPC, errno.EDQUOT)
+store_full = b"HTTP/1.1 507 - Message Store Full\r\n"
+mutating = (b"POST", b"PUT", b"DELETE")
+uncached = (b"range", b"if-none-match", b"if-modified-since")    #headers of requests the cache does not answer
+head_template = HeadTemplate(server_name)
+routes = Router()
 
 
-class MyTCPHandler(socketserver.StreamRequestHandler):
+class lazy:
+    """
+    A class attribute that is made by factory(cls) the first time it is
+    used, so importing the module does not open anything. It can be set
+    before that, like __main__ does with the options.
     """
-    This class is responsible for handling a request. The whole class is
-    handed over as a parameter to the server instance so that it is capable
-    of processing request. The server will use the handle-method to do this.
-    It is instantiated once for each request!
-    Since it inherits from the StreamRequestHandler class, it has two very
-    usefull attributes you can use:
 
-    rfile - This is the whole content of the request, displayed as a python
-    file-like object. This means we can do readline(), readlines() on it!
+    def __init__(self, factory):
+        self.factory = factory
 
-    wfile - This is a file-like object which represents the response. We can
-    write to it with write(). When we do wfile.close(), the response is
-    automatically sent.
+    def __set_name__(self, owner, name):
+        self.owner = owner
+        self.name = name
 
-    The class has three important methods:
-    handle() - is called to handle each request.
-    setup() - Does nothing by default, but can be used to do any initial
-    tasks before handling a request. Is automatically called before handle().
-    finish() - Does nothing by default, but is called after handle() to do any
-    necessary clean up after a request is handled.
-    """   
+    def __get__(self, instance, cls):
+        value = self.factory(self.owner)
+        setattr(self.owner, self.name, value)
+        return value
 
-    def handle(self):
+
+class HTTPRouter:
+    """
+    The routing logic of the server, without any I/O. It gets a parsed
+    request through route() and answers it through respond(), which hands
+    the finished response to send(). The engines (MyTCPHandler here, and
+    HTTPProtocol in aio.py) inherit from this class and implement send().
+    """
+
+    store = lazy(lambda cls: MessageStore("messages.txt", max_msgs))
+    static = StaticFiles("src")
+    test_file = AppendFile("test.txt")
+    compressor = Compressor()
+    metrics = Metrics()
+    events = lazy(lambda cls: Events(cls.store))
+    admission = Admission(metrics=metrics)
+    response_cache = ResponseCache()
+    routes = routes
+
+    access_log = False          #print every request to stderr
+    auth_token = None           #bytes, if set POST, PUT and DELETE need "Authorization:Bearer <token>"
+    peer = "-"                  #address of the client
+    draining = False            #True when the server stops, connections close after their response
+
+    keep_alive_timeout = 5      #seconds an idle connection is kept open
+    header_timeout = 10         #seconds from the first byte of a request head to the end of it
+    body_timeout = 60           #seconds from the end of the head to the end of the body
+    max_requests = 100          #requests on one connection, 0 turns keep-alive off
+    served = 0                  #requests served on this connection
+    keep_alive = False          #if the connection is kept open after this response
+    chunked = False             #if the response can be sent with chunked transfer-encoding
+    headers = {}                #headers of the current request, lowercase names
+    head_size = 0               #bytes of the head of the current request
+    status_code = 0             #status code of the response, 0 until it is sent
+    bytes_sent = 0              #bytes of the response
+    recording = False           #if respond() keeps the response for the response cache
+    recorded = None             #(status, header, body, bytes sent) kept by respond()
+
+    max_line = 8190             #bytes of the request line
+    max_head = 1 << 16          #bytes of the request line and headers
+    max_headers = 100           #number of headers
+    max_body = 1 << 20          #bytes of a body that is read into memory
+    stream_at = 1024            #messages in a listing that is streamed instead of joined
+    max_wait = 30               #seconds a long-polling GET /messages?wait= may wait
+    heartbeat = 15              #seconds between comments on a quiet event stream
+    stream_timeout = 300        #seconds an event stream blocks a handler thread
+    blocking_slots = None       #threading.Semaphore of the handlers that may block in a long poll
+                                #or an event stream at once, None for no limit
+
+    def new_parser(self):
+        """Return a request parser with the limits of the server."""
+
+        return RequestParser(self.max_line, self.max_head, self.max_headers)
+
+    def start_request(self, version:bytes, connection:bytes):
         """
-        This method is responsible for handling an http-request. You can, and should(!),
-        make additional methods to organize the flow with which a request is handled by
-        this method. But it all starts here!
+        Decide if the connection is kept open after the response to this
+        request, from the version and the Connection header of the request.
         """
 
-        #get the request line
-        request_line = self.rfile.readline().split(b" ")
-        if len(request_line) != 3:
-            self.respond(b"HTTP/1.1 400 Bad Request\r\n")
-            return
-
+        self.served += 1
+        self.chunked = version == b"HTTP/1.1"
+        connection = connection.lower()
+        if b"close" in connection:
+            keep_alive = False
+        elif b"keep-alive" in connection:
+            keep_alive = True
         else:
-            met = request_line[0]
-            uri = request_line[1]
-            version = request_line[2][0:-2]
+            keep_alive = version == b"HTTP/1.1"
 
-        #avoid potencial errors
-        if uri == b'':
-            self.respond(b"HTTP/1.1 400 Bad Request\r\n")
-        
-        #get path from uri even if it starts with '/'
-        list = uri.split(b'/', 1)
-        path = list[0] if list[0] != b'' else list[1]   
+        self.keep_alive = keep_alive and self.served < self.max_requests and not self.draining
 
-        #get the request content lenght and type
-        c_lenght, c_type = self.read_headers()
+    @classmethod
+    def stopped(cls):
+        """Called when the server has stopped and the requests in flight are done."""
 
-        #get the request body
-        body = self.rfile.read(c_lenght)
+        cls.store.flush()
 
-        #print(request_line)
+    def route(self, met:bytes, uri:bytes, body):
+        """
+        Find the route of the request and handle it through the middleware.
+        body is a readable stream of the request body.
+        """
 
-        #handle request
-        if met == b"GET":
-            self.handle_get(uri, path)
-            
-        elif met == b"POST":
-            self.handle_post(uri, path, body)
-    
-        elif met == b"PUT":
-            self.handle_put(uri, path, body)
+        path, route, params = self.match(met, uri)
+        self.pipeline(Call(met, uri, path, body, route, params))
 
-        elif met == b"DELETE":
-            self.handle_delete(uri, path, body)
+    def match(self, met:bytes, uri:bytes):
+        """Return the path of the request, its route (None if it has none) and the parameters in the path."""
 
-        elif met in valid_req:
-            self.respond(b"HTTP/1.1 501 Method not implemented\r\n")
+        path = uri.partition(b"?")[0]
+        if path.startswith(b"/"):
+            path = path[1:]
+        route, params = self.routes.match(met, path)
+        return path, route, params
 
-        else:
-            self.respond(b"HTTP/1.1 400 Invalid Method\r\n")
+    @classmethod
+    def build(cls):
+        """Put together the middleware and endpoint() into the pipeline every request goes through."""
 
-    def respond(self, status:bytes, header:bytes = b"", body:bytes = b""):
-        """Combine status and optionally header and body, then respond."""
+        middleware = [cls.measure]
+        if cls.access_log:
+            middleware.append(cls.log_access)
+        if cls.auth_token is not None:
+            middleware.append(cls.authorize)
+        if cls.response_cache is not None:
+            middleware.append(cls.cached)
+        cls.pipeline = pipeline(middleware, cls.endpoint)
 
-        if header == b"":
-            header = self.make_head()
+    def measure(self, call:Call, next):
+        """Middleware that records the request in the metrics."""
 
-        self.wfile.write(status + header + b"\r\n" + body)
-        self.wfile.close()
+        started = time.perf_counter()
+        self.status_code = self.bytes_sent = 0
+        try:
+            next(self, call)
+        finally:
+            if self.status_code:
+                self.metrics.observe(call.method.decode() if call.method in valid_req else "other",
+                                     call.route.name if call.route is not None else "static",
+                                     self.status_code, time.perf_counter() - started,
+                                     self.head_size + self.parser.body_bytes, self.bytes_sent)
+
+    def log_access(self, call:Call, next):
+        """Middleware that prints every request in the common log format."""
+
+        next(self, call)
+        print('%s - - [%s] "%s" %d %d' % (self.peer, time.strftime("%d/%b/%Y:%H:%M:%S %z"),
+                                          (call.method + b" " + call.uri).decode("latin-1"),
+                                          self.status_code, self.bytes_sent),
+              file=sys.stderr)
+
+    def authorize(self, call:Call, next):
+        """Middleware that only lets requests that change something through with the auth token."""
+
+        if call.method in mutating and call.route is not None:
+            if not hmac.compare_digest(self.headers.get(b"authorization", b""),
+                                       b"Bearer " + self.auth_token):
+                self.respond(status_lines[401], self.make_head() + b"WWW-Authenticate:Bearer\r\n")
+                return
+        next(self, call)
+
+    def cached(self, call:Call, next):
+        """
+        Middleware that answers a GET request of a route with a cache version
+        from the response cache, by path, content encoding and the version of
+        the resource. A response is only kept if it was sent with a single
+        respond(), as a 200 with the body in memory.
+        """
 
-    def ret_index(self):
-        """Respond with the index as the body."""
+        route = call.route
+        if (call.method != b"GET" or route is None or route.cache is None
+                or any(x in self.headers for x in uncached)):
+            next(self, call)
+            return
 
-        with open("src/index.html", "rb") as file:
-            body = file.read()
+        version = getattr(self, route.cache)(call)
+        if version is None:
+            next(self, call)
+            return
 
-        header = self.make_head(b"text/html", str(len(body)))
-        self.respond(b"HTTP/1.1 200 OK\r\n" , header, body)
+        encoding = self.compressor.negotiate(self.headers.get(b"accept-encoding", b""))
+        key = (route.cache, call.uri, encoding)
+        entry = self.response_cache.get(key, version)
+        if entry is not None:
+            #only the date of the head changes
+            _, status, header, body = entry
+            self.respond(status, head_template.get() + header, body)
+            return
 
-    def read_headers(self, max_read = 30):
-        """Read up to max_read headers and return the content-lenght and content-type."""
-        i = 0
-        lenght = b"0"
-        type = b"none"
+        prefix = head_template.get()
+        self.recording, self.recorded = True, None
+        try:
+            next(self, call)
+        finally:
+            self.recording = False
+        if self.recorded is None or self.status_code != 200:
+            return
 
-        #read the header line, then convert it to lowercase and
-        #split the header name from the header value
-        header = self.rfile.readline().lower().split(b":")
-        while header[0] != b"\r\n" and i < max_read:
-            if header[0] == b"content-length":
-                lenght = header[1]
-            
-            elif header[0] == b"content-type":
-                type = header[1]
+        status, header, body, sent = self.recorded
+        self.recorded = None
+        if sent == self.bytes_sent and header.startswith(prefix):
+            self.response_cache.put(key, version, status, header[len(prefix):], bytes(body))
 
-            header = self.rfile.readline().lower().split(b":")
-            i+=1
+    def file_version(self, call:Call):
+        """Return the version of a static file for the response cache, or None if it has none."""
 
         try:
-            lenght = int(lenght.decode())
+            st = os.stat(self.static.resolve(call.params.get("path", b"index.html")))
+        except OSError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
 
-        except:
-            lenght = 0
+    def messages_version(self, call:Call):
+        """
+        Return the version of the messages for the response cache, None for
+        a long poll. A change of the messages makes it a new version, so the
+        responses from before it are not used again.
+        """
 
-        return lenght, type
+        if b"wait=" in call.uri:
+            return None
+        return (id(self.store),) + self.store.stamp()   #the store can be replaced
 
-    def make_head(self, type:bytes = b'None', lenght:str ="0"):
-        """"Makes a header with the date, server name, content lenght and content type."""
+    def reject(self, status:bytes):
+        """Respond to a request that can not be parsed, and close the connection."""
 
-        #Takes the currect UTC time and convertes it into 
-        # string and a compliant format, then convertes that into bytes
-        binary_time = datetime.utcnow().strftime("%a, %d %b %Y %H:%M:%S GMT").encode()
-        
-        return (b"Date:" + binary_time + b" \r\n" 
-              + b"Server:" + server_name + b" \r\n" 
-              + b"Content-Type:" + type + b"\r\n"
-              + b"Content-Length:" + lenght.encode() + b"\r\n")
+        self.keep_alive = False
+        self.respond(status)
+        self.metrics.rejected(self.status_code)
 
-    def handle_get(self, uri:bytes, path:bytes):
-        """Handles GET request based on the URI."""
+    def endpoint(self, call:Call):
+        """
+        Handle the request with the handler of its route. Only the routes
+        that stream take the body as a stream, for the rest it is read into
+        memory, up to max_body bytes.
+        """
+
+        #avoid potencial errors
+        if call.uri == b'':
+            self.respond(status_lines[400])
+            return
 
-        if uri == b"/" or path == b"index" or path == b"index.html":
-            self.ret_index()
+        body = call.body
+        if call.route is None or not call.route.stream:
+            body = body.read(self.max_body + 1)
+            if len(body) > self.max_body:
+                self.keep_alive = False
+                self.respond(status_lines[413])
+                return
 
-        elif path == b"messages":
-            self.get_all()
+        if call.route is not None:
+            getattr(self, call.route.handler)(call.uri, body, **call.params)
 
-        elif uri == b"server.py" or b"../" in uri:
-            self.respond(b"HTTP/1.1 403 Forbidden\r\n")
+        elif call.method in mutating:
+            self.respond(status_lines[403])
+
+        elif call.method in valid_req:
+            self.respond(status_lines[501])
 
         else:
-            self.respond(b"HTTP/1.1 404 Not Found\r\n")
+            self.respond(b"HTTP/1.1 400 Invalid Method\r\n")
+
+    def send(self, data:bytes):
+        """Send a complete response to the client."""
+
+        raise NotImplementedError
 
-    def handle_post(self, uri:bytes, path:bytes, body:bytes):
-        """Handles POST request based on the URI."""
+    def send_file(self, file, offset:int, count:int):
+        """Send count bytes of file from offset to the client, after what was sent before."""
 
-        if path == b"test.txt":
-            self.post_test(body)
+        while count > 0:
+            data = os.pread(file.fileno(), min(count, 1 << 16), offset)
+            if not data:
+                raise EOFError("the file is shorter than the response")
+            self.send(data)
+            offset += len(data)
+            count -= len(data)
 
-        elif path == b'messages':
-            self.add_msg(body)
+    def send_parts(self, parts):
+        """Send a response made of several parts, without joining them if the engine can."""
 
+        self.send(b"".join(parts))
+
+    def send_stream(self, chunks):
+        """Send the parts of every chunk in chunks, as they are made."""
+
+        for parts in chunks:
+            self.send_parts(parts)
+
+    def respond(self, status:bytes, header:bytes = b"", body:bytes = b""):
+        """Combine status and optionally header and body, then respond."""
+
+        recording = self.recording and not self.bytes_sent
+        self.recording = False
+
+        if body:
+            self.bytes_sent += len(body)
+            self.send_parts((self.finish_head(status, header), body))
         else:
-            self.respond(b"HTTP/1.1 403 Forbidden\r\n")
+            self.send(self.finish_head(status, header))
 
-    def handle_put(self, uri:bytes, path:bytes, body:bytes):
-        """Handles PUT request based on the URI."""
+        if recording:
+            self.recorded = (status, header, body, self.bytes_sent)
 
-        if path == b"messages":
-            self.replace_msg(uri, body)
+    def respond_content(self, header:bytes, type:bytes, length:int, tail:bytes, file,
+                        etag:bytes = None, modified:float = None):
+        """
+        Respond with a body of length bytes, of which the last are in tail
+        and all are in file, or with the parts of it in the Range header:
+        206 with one range, or with several as multipart/byteranges. If an
+        If-Range header does not match etag or modified, the whole body is
+        sent. header has the headers besides Content-Type and Content-Length.
+        """
+
+        header += b"Accept-Ranges:bytes\r\n"
+        ranges = None
+        if if_range(self.headers.get(b"if-range"), etag, modified):
+            try:
+                ranges = parse_ranges(self.headers.get(b"range"), length)
+            except Unsatisfiable:
+                self.respond(status_lines[416], self.make_head(type) + header
+                                                + b"Content-Range:bytes */%d\r\n" % length)
+                return
+
+        if ranges is None:
+            self.respond_span(status_lines[200], self.make_head(type, length) + header,
+                              tail, file, length, 0, length)
+            return
+
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            header += b"Content-Range:bytes %d-%d/%d\r\n" % (start, end - 1, length)
+            self.respond_span(status_lines[206], self.make_head(type, end - start) + header,
+                              tail, file, length, start, end)
+            return
 
+        boundary = os.urandom(8).hex().encode()
+        heads = [b"\r\n--%s\r\nContent-Type:%s\r\nContent-Range:bytes %d-%d/%d\r\n\r\n"
+                 % (boundary, type, start, end - 1, length) for start, end in ranges]
+        closing = b"\r\n--%s--\r\n" % boundary
+        size = sum(map(len, heads)) + sum(end - start for start, end in ranges) + len(closing)
+        header = self.make_head(b"multipart/byteranges; boundary=" + boundary, size) + header
+
+        #the parts in memory are sent together, the ones in file with sendfile
+        parts = [self.finish_head(status_lines[206], header)]
+        self.bytes_sent += size
+        offset = length - len(tail)
+        for head, (start, end) in zip(heads, ranges):
+            parts.append(head)
+            if start >= offset:
+                parts.append(tail[start - offset:end - offset])
+            else:
+                self.send_parts(parts)
+                parts = []
+                self.send_file(file, start, end - start)
+        parts.append(closing)
+        self.send_parts(parts)
+
+    def respond_span(self, status:bytes, header:bytes, tail:bytes, file, length:int,
+                     start:int, end:int):
+        """Respond with the bytes from start to end of a body like the one of respond_content()."""
+
+        offset = length - len(tail)
+        if start >= offset:
+            self.respond(status, header, tail[start - offset:end - offset])
         else:
-            self.respond(b"HTTP/1.1 403 Forbidden\r\n")
+            self.send(self.finish_head(status, header))
+            self.bytes_sent += end - start
+            self.send_file(file, start, end - start)
+
+    def respond_chunked(self, status:bytes, header:bytes, chunks):
+        """
+        Respond with the body made by chunks, a generator of bytes, with
+        chunked transfer-encoding. The body is never all in memory.
+        """
 
-    def handle_delete(self, uri:bytes, path:bytes, body:bytes):
-        """Handles DELETE request based on the URI."""
+        def framed():
+            yield (self.finish_head(status, header + b"Transfer-Encoding:chunked\r\n"),)
+            for chunk in chunks:
+                if chunk:
+                    line = b"%x\r\n" % len(chunk)
+                    self.bytes_sent += len(line) + len(chunk) + 2
+                    yield (line, chunk, b"\r\n")
+            yield (b"0\r\n\r\n",)
 
-        if path == b"messages":
-            self.delete(uri, body)
+        self.send_stream(framed())
 
+    def finish_head(self, status:bytes, header:bytes):
+        """Return the status and header, with the connection headers and the empty line after them."""
+
+        if header == b"":
+            header = self.make_head()
+
+        if self.keep_alive:
+            head = b"%s%sConnection:keep-alive\r\nKeep-Alive:timeout=%d, max=%d\r\n\r\n" % (
+                status, header, self.keep_alive_timeout, self.max_requests - self.served)
         else:
-            self.respond(b"HTTP/1.1 403 Forbidden\r\n")
+            head = b"%s%sConnection:close\r\n\r\n" % (status, header)
+
+        self.status_code = int(status[9:12])
+        self.bytes_sent += len(head)
+        return head
+
+    def validators(self, etag:bytes, modified:float):
+        """Return the ETag and Last-Modified headers for a resource."""
+
+        return (b"ETag:" + etag + b"\r\n"
+              + b"Last-Modified:" + formatdate(modified, usegmt=True).encode() + b"\r\n")
+
+    def not_modified(self, etag:bytes, modified:float):
+        """
+        Return True if the If-None-Match or If-Modified-Since header of the
+        request shows that the client already has this version of the resource.
+        """
+
+        if b"if-none-match" in self.headers:
+            tags = [x.strip() for x in self.headers[b"if-none-match"].split(b",")]
+            return b"*" in tags or etag in tags or b"W/" + etag in tags
+
+        if b"if-modified-since" in self.headers:
+            try:
+                since = parsedate_to_datetime(self.headers[b"if-modified-since"].decode())
+                return int(modified) <= since.timestamp()
+            except (ValueError, TypeError):
+                return False
+
+        return False
+
+    @routes.route(b"GET", b"", b"index", b"index.html", name="/", cache="file_version")
+    def ret_index(self, uri:bytes, body:bytes):
+        """Respond with the index as the body."""
+
+        self.ret_file(uri, body, b"index.html")
+
+    @routes.route(b"GET", b"{path*}", name="static", cache="file_version")
+    def ret_file(self, uri:bytes, body:bytes, path:bytes):
+        """Respond with the static file at path as the body."""
+
+        try:
+            entry = self.static.open(path)
+
+        except PermissionError:
+            self.respond(status_lines[403])
+            return
+
+        except OSError:
+            self.respond(status_lines[404])
+            return
+
+        #a range is of the file as it is, not compressed
+        modified = entry.mtime / 1e9
+        if entry.body is not None and b"range" not in self.headers:
+            self.respond_tagged(status_lines[200], entry.type, entry.body,
+                                entry.path.encode(), entry.etag, modified)
+            return
+
+        header = self.validators(entry.etag, modified)
+        if self.not_modified(entry.etag, modified):
+            self.respond(status_lines[304], self.make_head(entry.type, entry.size) + header)
+            return
 
-    def add_msg(self, body:bytes):
-        """Assigns an id to the message in the input body and saves it in messages.txt"""
+        self.respond_content(header, entry.type, entry.size, entry.body or b"", entry.file,
+                             entry.etag, modified)
+
+    def respond_tagged(self, status:bytes, type:bytes, body:bytes, resource:bytes,
+                       etag:bytes, modified:float):
+        """
+        Respond with a body that has validators. It is answered with 304 if
+        the client has it already, and compressed if the client accepts it.
+        """
+
+        extra = b""
+        if self.compressor.compressible(type, len(body)):
+            extra = b"Vary:Accept-Encoding\r\n"
+            encoding = self.compressor.negotiate(self.headers.get(b"accept-encoding", b""))
+            if encoding is not None:
+                body = self.compressor.compress(resource, etag, encoding, body)
+                etag = etag[:-1] + b"-" + encoding + b'"'
+                extra += b"Content-Encoding:" + encoding + b"\r\n"
+
+        header = (self.make_head(type, len(body))
+                + self.validators(etag, modified) + extra)
+        if self.not_modified(etag, modified):
+            self.respond(status_lines[304], header)
+            return
+
+        self.respond(status, header, body)
+
+    def make_head(self, type:bytes = b'None', lenght:int = 0):
+        """"Makes a header with the date, server name, content lenght and content type.
+        Without a lenght (None) there is no Content-Length, for chunked responses."""
+
+        #the date and server name are prepared once a second by the template
+        if lenght is None:
+            return b"%s%s\r\n" % (head_template.get(), type)
+        return b"%s%s\r\nContent-Length:%d\r\n" % (head_template.get(), type, lenght)
+
+    @routes.route(b"POST", b"messages")
+    def add_msg(self, uri:bytes, body:bytes):
+        """Assigns an id to the message in the input body and saves it in the message store"""
 
         #check for valid message body
-        if not self.valid_body(body):
+        message = self.parse_message(body)
+        if message is None or message.text is None:
             self.respond(b"HTTP/1.1 400 - Bad Body\r\n")
             return
 
-        #find unsused ID
-        used_id = self.used_id(integer=True)
-        for x in range(max_msgs):
-            if x not in used_id:
-                id = str(x).encode()
-                break
+        try:
+            record = self.store.add(message)
+        except OSError as error:
+            if error.errno not in no_space:
+                raise
+            record = None
+
+        if record is None:
+            self.respond(store_full)
+            return
 
-        new_body = self.make_body(id, body)
+        new_body = b"," + record
+        header = self.make_head(b"text/json", len(new_body))
+        self.respond(b"HTTP/1.1 201 - Created\r\n", header, new_body)
 
-        with open("messages.txt", "ab") as file:
-            file.write(new_body)
+    @routes.route(b"POST", b"messages/batch", name="/messages")
+    def batch(self, uri:bytes, body:bytes):
+        """
+        Apply a json list of operations on the messages, all or none of them:
+        {"op": "create", "text": ...}, {"op": "replace", "id": ..., "text": ...}
+        or {"op": "delete", "id": ...}. Respond with a list of the results,
+        with 409 and the status of every operation if any of them can not be
+        done (424 for the ones that could).
+        """
 
-        header = self.make_head(b"text/json", str(len(new_body)))
-        self.respond(b"HTTP/1.1 201 - Created\r\n", header, new_body)
+        try:
+            requested = loads(body)
+            if not isinstance(requested, list):
+                raise ValueError(requested)
+
+            operations = []
+            for operation in requested:
+                op = operation["op"]
+                id = operation.get("id")
+                text = operation.get("text")
+                valid_id = isinstance(id, int) and not isinstance(id, bool)
+                if op == "create" and isinstance(text, str):
+                    message = Message(None, dump_text(text))
+                elif op == "replace" and isinstance(text, str) and valid_id:
+                    message = Message(id, dump_text(text))
+                elif op == "delete" and valid_id:
+                    message = Message(id)
+                else:
+                    raise ValueError(operation)
+                operations.append((op.encode(), message))
+
+        except (ValueError, TypeError, KeyError, AttributeError):
+            self.respond(b"HTTP/1.1 400 - Bad Batch\r\n")
+            return
+
+        try:
+            done, results = self.store.batch(operations)
+        except OSError as error:
+            if error.errno not in no_space:
+                raise
+            self.respond(store_full)
+            return
 
-    def post_test(self, body:bytes):
-        """Saves the input body in text.txt and returns the content of text.txt"""
+        if done:
+            status = b"HTTP/1.1 200 - OK\r\n"
+            items = [b'{"status": 200,"id": %d}' % message.id if record is None else
+                     b'{"status": %d,"message": %s}' % (201 if op == b"create" else 200, record)
+                     for (op, message), record in zip(operations, results)]
+        else:
+            status = status_lines[409]
+            items = [b'{"status": %d}' % (error or 424) for error in results]
+
+        new_body = b"[" + b",".join(items) + b"]"
+        self.respond(status, self.make_head(b"text/json", len(new_body)), new_body)
+
+    @routes.route(b"POST", b"test.txt", stream=True)
+    def post_test(self, uri:bytes, body):
+        """
+        Saves the input body in text.txt and returns the content of text.txt,
+        like get_test(). The body is a stream, it is copied to the file piece
+        by piece.
+        """
 
-        with open("test.txt", "ab") as file:
-            file.write(body)
-            
-        with open("test.txt", "rb") as file:
-            new_body = file.read(-1)
+        self.test_file.append(body)
+        self.get_test(uri, b"")
 
-        header = self.make_head(b"text", str(len(new_body)))
-        self.respond(b"HTTP/1.1 200 OK\r\n", header, new_body)
+    @routes.route(b"GET", b"test.txt")
+    def get_test(self, uri:bytes, body:bytes):
+        """
+        Returns the content of text.txt, or the parts of it in the Range
+        header, without reading the file back (see AppendFile).
+        """
 
-    def replace_msg(self, uri:bytes, body:bytes):
+        length, tail, file = self.test_file.snapshot()
+        self.respond_content(b"", b"text", length, tail, file)
+
+    @routes.route(b"PUT", b"messages", b"messages/{id}", name="/messages")
+    def replace_msg(self, uri:bytes, body:bytes, id:bytes = None):
         """Replace the message with the given ID, with the text in body. 
         Send response with the new message."""
 
         #check for valid message body
-        if not self.valid_body(body):
+        message = self.parse_message(body)
+        if message is None or message.text is None:
             self.respond(b"HTTP/1.1 400 - Bad Body\r\n")
             return
 
-        #get ID and check if it is in use
-        id = self.get_id(uri, body)
-        if id == b'':
+        #get ID, the store checks if it is in use
+        message.id = self.get_id(id, message)
+        if message.id is None:
             self.respond(b"HTTP/1.1 400 - Bad Message ID\r\n")
             return
 
-        elif id not in self.used_id():
-            self.respond(b"HTTP/1.1 404 - Could Not Find Message With Given ID\r\n")
+        try:
+            record = self.store.replace(message)
+        except OSError as error:
+            if error.errno not in no_space:
+                raise
+            self.respond(store_full)
             return
 
-        self.delete_msg(id)
+        if record is None:
+            self.respond(b"HTTP/1.1 404 - Could Not Find Message With Given ID\r\n")
+            return
 
-        #add replacement message
-        new_body = self.make_body(id, body)
-        with open("messages.txt", "ab") as file:
-            file.write(new_body)
-        header = self.make_head(b"text/json", str(len(new_body)))
+        new_body = b"," + record
+        header = self.make_head(b"text/json", len(new_body))
         self.respond(b"HTTP/1.1 200 - OK\r\n", header, new_body)
 
-    def delete(self, uri:bytes, body:bytes):
+    @routes.route(b"DELETE", b"messages", b"messages/{id}", name="/messages")
+    def delete(self, uri:bytes, body:bytes, id:bytes = None):
         """Remove the message with the given ID."""
 
-        id = self.get_id(uri, body)
-        if id == b'':
+        id = self.get_id(id, self.parse_message(body) or Message())
+        if id is None:
             self.respond(b"HTTP/1.1 400 - Bad Message ID\r\n")
             return
 
-        if id in self.used_id():
-            self.delete_msg(id)
+        try:
+            self.store.delete(id)
+        except OSError as error:
+            if error.errno not in no_space:
+                raise
+            self.respond(store_full)
+            return
 
         self.respond(b"HTTP/1.1 200 - OK\r\n")
 
-    def valid_body(self, body:bytes):
+    def parse_message(self, body:bytes):
+        """Return the Message in the body, or None if the body is not a valid message."""
+
+        try:
+            return Message.parse(body)
+        except ValueError:
+            return None
+
+    @routes.route(b"GET", b"messages", cache="messages_version")
+    def get_all(self, uri:bytes, body:bytes):
         """
-        Check if the body has a valid json format. Then check for illegal
-        characters ( "{" and "}" ). Lastly check if there is a text field.
-        Return true if all conditions are fulfilled.
+        Return a json formated list of the messages and their ids, return an
+        empty list if there are no messages.
+
+        The query parameters limit, after_id and since select a part of the
+        listing (see MessageStore.query), and the X-Messages-Version header
+        gives the version to ask for with since next time. Big listings are
+        streamed with chunked transfer-encoding.
         """
 
+        query = parse_qs(uri.partition(b"?")[2].decode("latin-1"))
         try:
-            json.loads(body)
+            params = {x: int(query[x][-1]) for x in ("limit", "after_id", "since") if x in query}
+            wait = float(query["wait"][-1]) if "wait" in query else None
+        except ValueError:
+            self.respond(status_lines[400])
+            return
+        if params.get("limit", 0) < 0 or not (wait is None or 0 <= wait):
+            self.respond(status_lines[400])
+            return
 
-        except:
-            return False
+        if wait is not None:
+            #long poll: answer when there are changes after since, or when the wait is over
+            since = params.setdefault("since", self.store.refresh())
+            if not self.hold():
+                return
+            try:
+                self.wait_for_change(since, min(wait, self.max_wait), lambda: self.respond_listing(params))
+            finally:
+                self.release()
+            return
 
-        if b'{' in body[1:] or b'}' in body[:-2]:
-            return False
+        if params or (self.chunked and len(self.store) > self.stream_at):
+            self.respond_listing(params)
+            return
 
-        elif b'"text": ' not in body:
-            return False
+        body, etag, modified = self.store.tagged()
+
+        lenght = len(body)
+        if lenght <= 2:
+            status = b"HTTP/1.1 200 - No Messages Found\r\n"
+        
+        else:
+            status = b"HTTP/1.1 200 - OK\r\n"
+
+        self.respond_tagged(status, b"text/json", body, b"messages", etag, modified)
+
+    @routes.route(b"GET", b"messages/{id}", name="/messages", cache="messages_version")
+    def get_msg(self, uri:bytes, body:bytes, id:bytes):
+        """Return the message with the ID in the path, with validators so it can be revalidated."""
+
+        id = self.get_id(id, Message())
+        if id is None:
+            self.respond(b"HTTP/1.1 400 - Bad Message ID\r\n")
+            return
+
+        entry = self.store.lookup(id)
+        if entry is None:
+            self.respond(b"HTTP/1.1 404 - Could Not Find Message With Given ID\r\n")
+            return
+
+        record, etag, modified = entry
+        self.respond_tagged(b"HTTP/1.1 200 - OK\r\n", b"text/json", record,
+                            b"messages/%d" % id, etag, modified)
 
-        return True
+    def respond_listing(self, params:dict):
+        """Respond with the part of the listing that params select."""
 
-    def used_id(self, integer=False):
+        records, version = self.store.query(**params)
+        status = b"HTTP/1.1 200 - OK\r\n" if records else b"HTTP/1.1 200 - No Messages Found\r\n"
+        header = b"X-Messages-Version:%d\r\n" % version
+
+        if self.chunked and len(records) > self.stream_at:
+            self.respond_chunked(status, self.make_head(b"text/json", None) + header,
+                                 self.listing_chunks(records))
+        else:
+            body = b"[" + b",".join(records) + b"]"
+            self.respond(status, self.make_head(b"text/json", len(body)) + header, body)
+
+    def wait_for_change(self, since:int, timeout:float, then):
         """
-        Return a list of the IDs in message.txt. If Integer is True, then
-        the IDs in the returned list are integers, otherwise they are bytes.
-        If there are no messages or if message.txt does not exist, then the
-        returned list is empty.
+        Call then() when the store version is no longer since, or after
+        timeout seconds. This blocks the handler, the asyncio engine
+        overrides it to wait without blocking.
         """
 
+        deadline = time.monotonic() + timeout
+        while self.store.refresh() == since:
+            left = deadline - time.monotonic()
+            if left <= 0 or self.draining:
+                break
+            #wake up every second, to see the changes of other processes too
+            self.events.wait(since, min(left, 1.0))
+
+        then()
+
+    @routes.route(b"GET", b"messages/events", name="/messages")
+    def get_events(self, uri:bytes, body:bytes):
+        """
+        Stream the changes of the messages as server-sent events, from the
+        version in the Last-Event-ID header or the since query parameter,
+        or from now.
+        """
+
+        query = parse_qs(uri.partition(b"?")[2].decode("latin-1"))
+        try:
+            since = int(self.headers.get(b"last-event-id") or query.get("since", [-1])[-1])
+        except ValueError:
+            self.respond(status_lines[400])
+            return
+
+        if not self.hold():
+            return
         try:
-            with open("messages.txt", "rb") as file:
-                messages = file.read(-1)
-        except:
-            return []
-
-        if messages:
-            parts = messages.split(b'{"id": ')[1:]
-            if integer:
-                return [int(x.split(b',')[0]) for x in parts]
+            self.keep_alive = False     #the stream ends when the connection does
+            head = self.finish_head(status_lines[200], self.make_head(b"text/event-stream", None)
+                                                     + b"Cache-Control:no-cache\r\n")
+            self.stream_events(head + b"retry: 1000\n\n", since if since >= 0 else self.store.refresh())
+        finally:
+            self.release()
+
+    def hold(self):
+        """
+        Take one of blocking_slots for a long poll or an event stream. If
+        there is none left, respond with 503 and return False, so they do
+        not take every handler that serves requests.
+        """
+
+        if self.blocking_slots is None or self.blocking_slots.acquire(False):
+            return True
+        self.keep_alive = False
+        self.respond(status_lines[503], self.make_head() + b"Retry-After:1\r\n")
+        return False
+
+    def release(self):
+        if self.blocking_slots is not None:
+            self.blocking_slots.release()
+
+    def stream_events(self, head:bytes, since:int):
+        """
+        Send head, then the events after since as they happen. A blocking
+        handler stops after stream_timeout seconds, and the client (an
+        EventSource) reconnects with the last event id, so a thread is not
+        held forever. A comment is sent every heartbeat seconds, which
+        notices a client that went away.
+        """
+
+        self.send(head)
+        deadline = time.monotonic() + self.stream_timeout
+        quiet = time.monotonic()
+        while time.monotonic() < deadline and not self.draining:
+            self.store.refresh()
+            events = self.events.since(since)
+            if events:
+                data = b"".join(x.encode() for x in events)
+                since = events[-1].version
+                quiet = time.monotonic()
+            elif time.monotonic() - quiet >= self.heartbeat:
+                data = b":\n\n"
+                quiet = time.monotonic()
             else:
-                return [x.split(b',')[0] for x in parts]
-        else:
-            return []
+                data = b""
+
+            if data:
+                self.bytes_sent += len(data)
+                self.send(data)
+            self.events.wait(since, 1.0)
+
+    def listing_chunks(self, records:list, size:int = 1 << 16):
+        """Yield the json list of records in pieces of about size bytes."""
+
+        yield b"["
+        start = total = 0
+        for i, record in enumerate(records):
+            total += len(record)
+            if total >= size or i == len(records) - 1:
+                #every piece after the first starts with the comma before it
+                yield b",".join(([b""] if start else []) + records[start:i + 1])
+                start, total = i + 1, 0
+        yield b"]"
+
+    @routes.route(b"GET", b"metrics")
+    def get_metrics(self, uri:bytes, body:bytes):
+        """Respond with the metrics of this process, in the Prometheus text format."""
+
+        body = self.metrics.render({
+            "messages_stored": ("Messages in the message store.", len(self.store)),
+            "messages_capacity": ("Messages the message store can hold.", self.store.capacity),
+            "message_log_bytes": ("Bytes of the message log.", self.store.log.size),
+            "response_cache_bytes": ("Bytes of the responses in the response cache.",
+                                     self.response_cache.size if self.response_cache else 0),
+        })
+        self.respond(status_lines[200], self.make_head(b"text/plain; version=0.0.4", len(body)), body)
+
+    def get_id(self, id:bytes, message:Message):
+        """Return ID either from the path or from the message, or None if there is none."""
+
+        #check for id in the path
+        if id is not None:
+            try:
+                return int(id)
+            except ValueError:
+                return None
+
+        return message.id
 
-    def get_all(self):
+
+HTTPRouter.build()
+
+
+class MyTCPHandler(HTTPRouter, socketserver.StreamRequestHandler):
+    """
+    This class is responsible for handling a request. The whole class is
+    handed over as a parameter to the server instance so that it is capable
+    of processing request. The server will use the handle-method to do this.
+    It is instantiated once for each connection, which can carry several
+    requests when it is kept alive!
+    Since it inherits from the StreamRequestHandler class, it has two very
+    usefull attributes you can use:
+
+    rfile - This is the whole content of the request, displayed as a python
+    file-like object. This means we can do readline(), readlines() on it!
+
+    wfile - This is a file-like object which represents the response. We can
+    write to it with write(). When we do wfile.close(), the response is
+    automatically sent.
+
+    The class has three important methods:
+    handle() - is called to handle each request.
+    setup() - Does nothing by default, but can be used to do any initial
+    tasks before handling a request. Is automatically called before handle().
+    finish() - Does nothing by default, but is called after handle() to do any
+    necessary clean up after a request is handled.
+    """   
+
+    def handle(self):
         """
-        Return a json formated list of the messages and their ids, return an
-        empty list if there are no messages.
+        This method is responsible for handling an http-request. You can, and should(!),
+        make additional methods to organize the flow with which a request is handled by
+        this method. But it all starts here!
         """
-        
+
+        while self.handle_one():
+            pass
+
+    def setup(self):
+        super().setup()
+        self.parser = self.new_parser()
+        self.peer = self.client_address[0]
+        self.metrics.connection_opened()
+
+    def finish(self):
+        self.metrics.connection_closed()
+        super().finish()
+
+    def handle_one(self):
+        """Handle one request. Return True if the connection is kept open for another."""
+
+        if self.served and self.draining:
+            return False
+        if self.served and not self.parser.buffer and not self.wait_idle():
+            return False
+
+        #wait for the request as long as an idle connection is kept open,
+        #then at most header_timeout for the whole head, however slowly it trickles in
+        self.status_code = 0
+        self.connection.settimeout(self.keep_alive_timeout)
+        deadline = time.monotonic() + self.header_timeout if self.parser.buffer else None
         try:
-            with open("messages.txt", "rb") as file:
-                messages = file.read(-1)
+            request = self.parser.next_request()
+            while request is None:
+                if deadline is not None:
+                    self.read_until(deadline)
+                data = self.rfile.read1(1 << 16)
+                if not data:
+                    return False    #the client closed the connection
+                if deadline is None:
+                    deadline = time.monotonic() + self.header_timeout
+                self.parser.feed(data)
+                request = self.parser.next_request()
+
+        except socket.timeout:
+            if deadline is not None:
+                self.timed_out()
+            return False
 
-            body = b"[" + messages[1:] + b"]"   #ignore first ','
+        except ConnectionError:
+            return False
 
-        except:
-            body = b"[]"
+        except ParseError as error:
+            self.reject(error.status)
+            return False
 
-        lenght = len(body)
-        if lenght <= 2:
-            status = b"HTTP/1.1 200 - No Messages Found\r\n"
-        
-        else:
-            status = b"HTTP/1.1 200 - OK\r\n"
+        self.headers = request.headers
+        self.head_size = request.size
+        self.start_request(request.version, self.headers.get(b"connection", b""))
 
-        header = self.make_head(b"text/json", str(lenght))
-        self.respond(status, header, body)
+        self.connection.settimeout(self.keep_alive_timeout)
+        deadline = time.monotonic() + self.body_timeout
 
-    def delete_msg(self, id:bytes):
-        """DELETE the message with the given ID"""
+        def fill():
+            self.read_until(deadline)
+            try:
+                return self.rfile.read1(1 << 16)
+            finally:
+                self.connection.settimeout(self.keep_alive_timeout)
 
+        body = body_stream(self.parser, fill)
         try:
-            with open("messages.txt", "rb") as file:
-                messages = file.read(-1)
+            self.route(request.method, request.uri, body)
+            if self.keep_alive:
+                self.skip_body(body)
 
-        except:
-            return  #no messages to delete
+        except socket.timeout:
+            if not self.parser.body_done:
+                self.timed_out()
+            return False
 
-        index = messages.find(b',{"id": ' + id + b',')  #start deleting from
-        end = messages.find(b'}',index) + 1     #end of message to be deleted
+        except ConnectionError:
+            return False
 
-        if end == -1:   #if the message cannot be found
-            return
+        except ParseError as error:
+            self.reject(error.status)
+            return False
 
-        #overwrite message with the rest of the file
-        with open("messages.txt", "wb") as file:
-            file.seek(index)
-            file.write(messages[end:])
+        return self.keep_alive
 
-    def make_body(self, id:bytes, body:bytes):
-        """Return a message with the input ID and body"""
+    def wait_idle(self):
+        """
+        Wait for the next request on an idle connection. A server that serves
+        one connection at a time closes it as soon as another connection
+        waits to be accepted, instead of keeping that one waiting until
+        keep_alive_timeout. Return False if the connection is closed.
+        """
 
-        new_body = body.split(b'"text": ',1)[-1]    #get the text
-        return b',{"id": ' + id + b',"text": ' + new_body
+        if not getattr(self.server, "serial", False):
+            return True
+        ready, _, _ = select.select([self.connection, self.server.socket], [], [], self.keep_alive_timeout)
+        return self.connection in ready
 
-    def get_id(self, uri:bytes, body:bytes):
-        """Return ID either from the URI or from the body """
+    def read_until(self, deadline:float):
+        """Let the next read wait until deadline at most, raise socket.timeout if it is over."""
 
-        #check for id in uri
-        if b"messages/" in uri:
-            id = uri.split(b"messages/")[-1]
+        left = deadline - time.monotonic()
+        if left <= 0:
+            raise socket.timeout("read deadline")
+        self.connection.settimeout(left)
 
-        #get id from body
-        else:
-            part = body.split(b'{"id": ',1)[-1]
-            part = part.split(b'}',1)[0]
-            id = part.split(b',',1)[0]
+    def timed_out(self):
+        """Answer a request that did not arrive in time with 408, unless a response was started."""
 
-        #check if id is a number
+        if self.status_code:
+            return
         try:
-            int(id)
-            return id
+            self.reject(status_lines[408])
+        except OSError:
+            pass
+
+    def skip_body(self, body, max_skip:int = 1 << 20):
+        """Read away what the route did not read of the body, or close the connection if it is too much."""
+
+        skipped = 0
+        while not self.parser.body_done:
+            data = body.read1(1 << 16)
+            skipped += len(data)
+            if not data or skipped > max_skip:
+                self.keep_alive = False
+                return
+
+    def send(self, data:bytes):
+        """Write the response to wfile."""
+
+        self.wfile.write(data)
+
+    def send_parts(self, parts):
+        """Send the parts with one writev (sendmsg) call, instead of joining them first."""
+
+        parts = [memoryview(x) for x in parts]
+        while parts:
+            sent = self.connection.sendmsg(parts)
+            while parts and sent >= len(parts[0]):
+                sent -= len(parts[0])
+                del parts[0]
+            if sent:
+                parts[0] = parts[0][sent:]
+
+    def send_file(self, file, offset:int, count:int):
+        """Send the file straight from the page cache to the socket, with sendfile."""
+
+        self.connection.sendfile(file, offset, count)
 
-        except:
-            return b''
 
 if __name__ == "__main__":
-    HOST, PORT = "localhost", 8080
-    socketserver.TCPServer.allow_reuse_address = True
-    with socketserver.TCPServer((HOST, PORT), MyTCPHandler) as server:
-        print("Serving at: http://{}:{}".format(HOST, PORT))
-        server.serve_forever()
+    import argparse
+    import servers
+    from wal import fsync_policies
+
+    #aio.py imports HTTPRouter from server, make that this module instead of a second copy
+    sys.modules["server"] = sys.modules[__name__]
+
+    parser = argparse.ArgumentParser(description="INF-2300 http server")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--engine", choices=("socketserver", "asyncio"), default="socketserver",
+                        help="the I/O engine (default: socketserver)")
+    parser.add_argument("--uvloop", action="store_true",
+                        help="run the asyncio engine on uvloop, if it is installed")
+    parser.add_argument("--mode", choices=servers.modes, default="single",
+                        help="how connections are served by the socketserver engine "
+                             "(default: single)")
+    parser.add_argument("--workers", type=int,
+                        help="threads in threaded mode (default: 32), "
+                             "processes in prefork mode (default: one per cpu)")
+    parser.add_argument("--max-streams", type=int,
+                        help="long polls and event streams that may hold a worker thread at once "
+                             "in threaded mode, more get 503 (default: a quarter of the workers). "
+                             "Single and prefork mode refuse them, the asyncio engine serves any number")
+    parser.add_argument("--keep-alive-timeout", type=float, default=HTTPRouter.keep_alive_timeout,
+                        help="seconds an idle connection is kept open")
+    parser.add_argument("--header-timeout", type=float, default=HTTPRouter.header_timeout,
+                        help="seconds a client has to send a request head, once it started")
+    parser.add_argument("--body-timeout", type=float, default=HTTPRouter.body_timeout,
+                        help="seconds a client has to send a request body")
+    parser.add_argument("--max-connections", type=int, default=0,
+                        help="open connections of a process, more are refused with 503 "
+                             "(default: 0, no limit)")
+    parser.add_argument("--max-per-client", type=int, default=0,
+                        help="open connections of a process from one client address "
+                             "(default: 0, no limit)")
+    parser.add_argument("--drain-timeout", type=float, default=servers.drain_timeout,
+                        help="seconds the requests in flight get to finish on SIGTERM or a "
+                             "SIGHUP reload")
+    parser.add_argument("--backlog", type=int, default=128,
+                        help="listen backlog, and connections waiting for a worker in threaded mode")
+    parser.add_argument("--backlog-policy", choices=servers.backlog_policies, default="reject",
+                        help="when every worker is busy and the backlog is full, refuse new "
+                             "connections with 503 or wait (default: reject)")
+    parser.add_argument("--max-requests", type=int, default=HTTPRouter.max_requests,
+                        help="requests served on one connection, 0 turns keep-alive off")
+    parser.add_argument("--max-headers", type=int, default=HTTPRouter.max_headers,
+                        help="number of headers in a request")
+    parser.add_argument("--max-head", type=int, default=HTTPRouter.max_head,
+                        help="bytes of the request line and headers of a request")
+    parser.add_argument("--root", default="src",
+                        help="document root of the static files (default: src)")
+    parser.add_argument("--max-messages", type=int, default=max_msgs,
+                        help="messages the store holds, 0 for no limit (default: 0)")
+    parser.add_argument("--fsync", choices=fsync_policies, default="interval",
+                        help="when message changes are forced to disk")
+    parser.add_argument("--storage", choices=("memory", "mmap"), default="memory",
+                        help="keep the messages in memory, or read them from a map of the log")
+    parser.add_argument("--response-cache", type=int, default=8 << 20,
+                        help="bytes of GET responses kept to answer the same requests again, "
+                             "0 turns the cache off (default: 8 MiB)")
+    parser.add_argument("--access-log", action="store_true",
+                        help="print every request to stderr")
+    parser.add_argument("--auth-token",
+                        help="token that POST, PUT and DELETE requests need as Authorization:Bearer")
+    args = parser.parse_args()
+    if args.keep_alive_timeout <= 0:
+        parser.error("--keep-alive-timeout must be positive")
+    if args.header_timeout <= 0 or args.body_timeout <= 0:
+        parser.error("--header-timeout and --body-timeout must be positive")
+
+    HOST, PORT = args.host, args.port
+    HTTPRouter.keep_alive_timeout = args.keep_alive_timeout
+    HTTPRouter.header_timeout = args.header_timeout
+    HTTPRouter.body_timeout = args.body_timeout
+    HTTPRouter.admission = Admission(args.max_connections, args.max_per_client, HTTPRouter.metrics)
+    servers.TCPServer.request_queue_size = args.backlog
+    servers.drain_timeout = args.drain_timeout
+    HTTPRouter.max_requests = args.max_requests
+    HTTPRouter.max_headers = args.max_headers
+    HTTPRouter.max_head = args.max_head
+    HTTPRouter.static = StaticFiles(args.root)
+    HTTPRouter.access_log = args.access_log
+    HTTPRouter.response_cache = ResponseCache(args.response_cache) if args.response_cache else None
+    HTTPRouter.auth_token = args.auth_token.encode() if args.auth_token else None
+    HTTPRouter.build()
+    #shared in every mode: prefork workers, and the old and new process of a SIGHUP reload,
+    #write the log at the same time
+    HTTPRouter.store = MessageStore("messages.txt", args.max_messages, args.storage == "mmap",
+                                    fsync=args.fsync, shared=True)
+    HTTPRouter.events = Events(HTTPRouter.store)
+
+    if args.engine == "asyncio":
+        import aio
+        aio.run((HOST, PORT), args.uvloop, args.backlog)
+    elif args.mode == "threaded":
+        servers.run_threaded((HOST, PORT), MyTCPHandler, args.workers or 32,
+                             args.backlog, args.backlog_policy, args.max_streams)
+    elif args.mode == "prefork":
+        servers.run_prefork((HOST, PORT), MyTCPHandler, args.workers or os.cpu_count() or 1)
+    else:
+        servers.run_single((HOST, PORT), MyTCPHandler)
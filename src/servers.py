@@ -0,0 +1,348 @@
+import os
+import queue
+import select
+import signal
+import socket
+import socketserver
+import subprocess
+import sys
+import threading
+import time
+from admission import overloaded
+
+"""
+The different ways to run the server:
+
+single   - one thread serves one connection at a time
+threaded - a bounded pool of worker threads serves the connections
+prefork  - several worker processes, each with its own listening socket
+           bound to the same port with SO_REUSEPORT
+
+The admission of the handler (see admission.py) decides which accepted
+connections are served, the rest get a quick 503. A long poll or an event
+stream blocks a handler for a long time: single and prefork mode refuse
+them with 503 (the asyncio engine serves them without blocking), threaded
+mode lets a part of the workers take them.
+
+SIGTERM and SIGINT drain the server: it stops accepting, gives the requests
+in flight drain_timeout seconds to finish, and calls stopped() of the
+handler class. SIGHUP reloads it without downtime: a new server process,
+with the code as it is on disk now, takes over the listening sockets, and
+when it serves, this one drains.
+"""
+
+modes = ("single", "threaded", "prefork")
+backlog_policies = ("reject", "wait")
+drain_timeout = 30          #seconds the requests in flight get to finish when the server stops
+listen_fds = "SERVER_LISTEN_FDS"    #environment variable with the sockets handed over by a reload
+ready_fd = "SERVER_READY_FD"        #environment variable with the pipe to tell we serve
+
+
+class TCPServer(socketserver.TCPServer):
+    """TCPServer that can share its port with other processes, and refuses connections it has no room for."""
+
+    allow_reuse_address = True
+    reuse_port = False
+    serial = True               #serves one connection at a time
+    request_queue_size = 128    #listen backlog
+
+    def __init__(self, *args, **kwargs):
+        self.admitted = {}      #socket -> client address, of the admitted connections
+        super().__init__(*args, **kwargs)
+
+    def server_bind(self):
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+    def verify_request(self, request, client_address):
+        admission = getattr(self.RequestHandlerClass, "admission", None)
+        if admission is None:
+            return True
+        if not admission.admit(client_address[0]):
+            self.refuse(request, False)
+            return False
+
+        self.admitted[request] = client_address[0]
+        return True
+
+    def refuse(self, request, count:bool = True):
+        """Answer a connection with 503 without waiting for its request, if the socket buffer has room."""
+
+        try:
+            request.setblocking(False)
+            request.send(overloaded)
+        except OSError:
+            pass
+
+        admission = getattr(self.RequestHandlerClass, "admission", None)
+        if count and admission is not None:
+            admission.refused()
+
+    def shutdown_request(self, request):
+        address = self.admitted.pop(request, None)
+        if address is not None:
+            self.RequestHandlerClass.admission.release(address)
+        super().shutdown_request(request)
+
+
+class PooledTCPServer(TCPServer):
+    """
+    Serves the connections with a fixed number of worker threads, instead
+    of one new thread per connection like ThreadingMixIn. Accepted
+    connections wait in a queue of at most backlog entries. When it is full,
+    new connections are refused with 503 if policy is "reject". With "wait"
+    the server stops accepting until a worker is free, and the rest wait in
+    the listen backlog of the kernel.
+    """
+
+    serial = False
+
+    def __init__(self, server_address, handler, workers:int = 8, backlog:int = 64,
+                 policy:str = "reject", **kwargs):
+        self.requests = queue.Queue(backlog)
+        self.policy = policy
+        self.deadline = None    #when workers are no longer waited for, after a drain
+        super().__init__(server_address, handler, **kwargs)
+
+        self.workers = []
+        for _ in range(workers):
+            thread = threading.Thread(target=self.work, daemon=True)
+            thread.start()
+            self.workers.append(thread)
+
+    def process_request(self, request, client_address):
+        try:
+            self.requests.put_nowait((request, client_address))
+        except queue.Full:
+            if self.policy == "wait":
+                self.requests.put((request, client_address))
+            else:
+                self.refuse(request)
+                self.shutdown_request(request)
+
+    def work(self):
+        """Worker thread, serves connections until it gets None."""
+
+        while True:
+            item = self.requests.get()
+            if item is None:
+                return
+
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        for _ in self.workers:
+            self.requests.put(None)
+        #the connections that were accepted are served, until the deadline of a drain
+        for thread in self.workers:
+            thread.join(None if self.deadline is None else max(0, self.deadline - time.monotonic()))
+
+
+def inherited_sockets():
+    """Return the listening sockets handed over by the process that reloaded into this one, if any."""
+
+    fds = os.environ.pop(listen_fds, "")
+    return [socket.socket(fileno=int(x)) for x in fds.split(",") if x]
+
+
+def signal_ready():
+    """Tell the process that reloaded into this one that we serve, so it can drain."""
+
+    fd = os.environ.pop(ready_fd, None)
+    if fd is not None:
+        os.write(int(fd), b"1")
+        os.close(int(fd))
+
+
+def reload(sockets:list, timeout:float = 10):
+    """
+    Start a new server process, with the same arguments, that takes over
+    the listening sockets. Return True when it serves, or False if it did
+    not start within timeout seconds, and then it is killed.
+    """
+
+    fds = [x.fileno() for x in sockets]
+    read, write = os.pipe()
+    env = dict(os.environ)
+    env[listen_fds] = ",".join(map(str, fds))
+    env[ready_fd] = str(write)
+    process = subprocess.Popen([sys.executable] + sys.argv, env=env, pass_fds=fds + [write])
+    os.close(write)
+
+    ready, _, _ = select.select([read], [], [], timeout)
+    started = bool(ready) and os.read(read, 1) == b"1"
+    os.close(read)
+    if not started:
+        process.kill()
+        print("Reload failed, still serving")
+    return started
+
+
+def make_server(server_class, address, handler, *args, sock:socket.socket = None):
+    """Return a server_class server, listening on sock if it is given instead of binding address."""
+
+    if sock is None:
+        return server_class(address, handler, *args)
+
+    server = server_class(address, handler, *args, bind_and_activate=False)
+    server.socket.close()
+    server.socket = sock
+    server.server_address = sock.getsockname()
+    return server
+
+
+def wait_for_signal(sockets:list = None):
+    """
+    Wait in the main thread for SIGINT or SIGTERM, and return which. With
+    the listening sockets, SIGHUP hands them over with reload() and returns
+    SIGHUP if that worked, otherwise it is ignored.
+    """
+
+    received = []
+    for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP):
+        signal.signal(signum, lambda signum, frame: received.append(signum))
+
+    while True:
+        while not received:
+            time.sleep(0.1)
+        signum = received.pop(0)
+        if signum != signal.SIGHUP:
+            return signum
+        if sockets is not None and reload(sockets):
+            return signum
+
+
+def drain(server, handler):
+    """Stop accepting, let the requests in flight finish within drain_timeout, then tell handler."""
+
+    handler.draining = True
+    deadline = time.monotonic() + drain_timeout
+
+    #in single mode shutdown() waits for the connection that is served
+    stopper = threading.Thread(target=server.shutdown, daemon=True)
+    stopper.start()
+    stopper.join(drain_timeout)
+
+    server.deadline = deadline
+    server.server_close()
+    handler.stopped()
+
+
+def serve(server):
+    """Serve until SIGINT or SIGTERM, then drain. SIGHUP reloads."""
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    signal_ready()
+    wait_for_signal([server.socket])
+    drain(server, server.RequestHandlerClass)
+
+
+def run_single(address, handler):
+    sockets = inherited_sockets()
+    server = make_server(TCPServer, address, handler, sock=sockets[0] if sockets else None)
+    handler.blocking_slots = threading.Semaphore(0)     #one would hold the only connection served
+    print("Serving at: http://{}:{}".format(*server.server_address[:2]))
+    serve(server)
+
+
+def run_threaded(address, handler, workers:int, backlog:int = 64, policy:str = "reject",
+                 streams:int = None):
+    """Serve with a pool of worker threads, of which streams (a quarter by default) may block in long polls."""
+
+    sockets = inherited_sockets()
+    handler.blocking_slots = threading.Semaphore(workers // 4 if streams is None else streams)
+    server = make_server(PooledTCPServer, address, handler, workers, backlog, policy,
+                         sock=sockets[0] if sockets else None)
+    print("Serving at: http://{}:{}".format(*server.server_address[:2]))
+    serve(server)
+
+
+def run_prefork(address, handler, workers:int):
+    """
+    Fork workers processes that each serve connections on their own socket.
+    The sockets are made here, bound to the same port with SO_REUSEPORT, so
+    a worker that dies is replaced on the same socket without losing the
+    connections waiting in its backlog, and a reload hands all of them over.
+    Without SO_REUSEPORT all workers share one socket.
+
+    SIGINT and SIGTERM drain the workers, which are killed if they take
+    longer than drain_timeout. SIGHUP reloads.
+    """
+
+    handler.blocking_slots = threading.Semaphore(0)     #a worker serves one connection at a time
+    inherited = inherited_sockets()
+    if inherited:
+        listeners = [make_server(TCPServer, address, handler, sock=x) for x in inherited]
+    elif hasattr(socket, "SO_REUSEPORT"):
+        listeners = []
+        for _ in range(workers):
+            server = TCPServer(address, handler, bind_and_activate=False)
+            server.reuse_port = True
+            server.server_bind()
+            server.server_activate()
+            listeners.append(server)
+            address = server.server_address     #the same port, also if it was 0
+    else:
+        listeners = [TCPServer(address, handler)]
+
+    def child(server):
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        wait_for_signal()       #the parent reloads, not the workers
+        drain(server, handler)
+        os._exit(0)
+
+    def spawn(slot:int):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                child(listeners[slot % len(listeners)])
+            finally:
+                os._exit(1)
+        return pid
+
+    children = {spawn(x): x for x in range(workers)}    #pid -> slot
+    print("Serving at: http://{}:{} with {} processes".format(address[0], address[1], workers))
+    signal_ready()
+
+    stopping = False
+    def stop(signum, frame):
+        nonlocal stopping
+        if signum == signal.SIGHUP and (stopping or not reload([x.socket for x in listeners])):
+            return
+        stopping = True
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+        signal.alarm(int(drain_timeout) + 1)
+
+    def kill(signum, frame):
+        for pid in children:
+            os.kill(pid, signal.SIGKILL)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGHUP, stop)
+    signal.signal(signal.SIGALRM, kill)
+
+    while children:
+        try:
+            pid, _ = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        slot = children.pop(pid, None)
+        if not stopping and slot is not None:
+            children[spawn(slot)] = slot
+
+    for server in listeners:
+        server.server_close()
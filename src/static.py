@@ -0,0 +1,105 @@
+import mimetypes
+import os
+import threading
+from collections import OrderedDict
+from urllib.parse import unquote_to_bytes
+
+"""
+Static files served from a document root.
+"""
+
+
+class StaticFile:
+    """
+    An open file from the document root. Small files are read into body
+    once, large files are sent from file with sendfile, without copying
+    them through userspace.
+    """
+
+    __slots__ = ("path", "file", "body", "size", "mtime", "type", "etag")
+
+    def __init__(self, path:str, size:int, mtime:int, type:bytes):
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+        self.type = type
+        self.file = None
+        self.body = None
+        self.etag = ('"%x-%x"' % (size, mtime)).encode()
+
+
+class StaticFiles:
+    """
+    Resolves request paths to files inside root and keeps the most recently
+    used ones open in an LRU cache. A cached file is used as long as its
+    size and mtime are unchanged, one stat per request instead of an open
+    and a read.
+
+    Paths that leave root, hidden files and files with a forbidden suffix
+    (like the source code of the server) raise PermissionError. Missing
+    files and directories raise FileNotFoundError.
+    """
+
+    forbidden = (".py", ".pyc")
+
+    def __init__(self, root:str, max_files:int = 256, max_body:int = 1 << 16):
+        self.root = os.path.realpath(root)
+        self.max_files = max_files
+        self.max_body = max_body   #bigger files are sent with sendfile
+        self.cache = OrderedDict()  #path -> StaticFile
+        self.lock = threading.Lock()
+
+    def resolve(self, path:bytes):
+        """Return the file system path for the path of a request."""
+
+        path = unquote_to_bytes(path.split(b"?", 1)[0]).lstrip(b"/")
+        if b"\0" in path:
+            raise PermissionError(path)
+
+        full = os.path.realpath(os.path.join(self.root, os.fsdecode(path)))
+        if not full.startswith(self.root + os.sep):
+            raise PermissionError(path)
+
+        relative = full[len(self.root) + 1:]
+        if relative.endswith(self.forbidden) or any(x.startswith(".") for x in relative.split(os.sep)):
+            raise PermissionError(path)
+
+        return full
+
+    def open(self, path:bytes):
+        """Return the StaticFile for the path of a request."""
+
+        full = self.resolve(path)
+        st = os.stat(full)
+        if not os.path.isfile(full):
+            raise FileNotFoundError(full)
+
+        with self.lock:
+            entry = self.cache.get(full)
+            if entry is not None and entry.mtime == st.st_mtime_ns and entry.size == st.st_size:
+                self.cache.move_to_end(full)
+                return entry
+
+        type = mimetypes.guess_type(full)[0] or "application/octet-stream"
+        if type.startswith("text/"):
+            type += "; charset=utf-8"
+
+        entry = StaticFile(full, st.st_size, st.st_mtime_ns, type.encode())
+        file = open(full, "rb", buffering=0)
+        if st.st_size <= self.max_body:
+            with file:
+                body = file.read()
+            if len(body) != st.st_size:     #changed while we read it
+                entry = StaticFile(full, len(body), st.st_mtime_ns, entry.type)
+            entry.body = body
+        else:
+            #closed when the last response sending it drops it
+            entry.file = file
+
+        with self.lock:
+            self.cache[full] = entry
+            self.cache.move_to_end(full)
+            while len(self.cache) > self.max_files:
+                self.cache.popitem(last=False)
+
+        return entry
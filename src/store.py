@@ -0,0 +1,458 @@
+import bisect
+import threading
+import time
+from collections import OrderedDict
+from hashlib import blake2b
+from message import Message
+from wal import MessageLog, batch_id, mark_id, records, replay
+
+"""
+In-memory message store shared by every request handler.
+"""
+
+
+class MessageStore:
+    """
+    Keeps every message in memory, indexed by id, and only touches the
+    messages file on disk to keep it durable. The file is an append-only
+    log (see wal.py), so every change is one small appended record.
+
+    If the file is changed or removed by someone else, the store notices it
+    on the next call (by comparing the stat of the file) and reloads it, or
+    only applies the new records if someone appended to it. With shared=True
+    the file is also locked during every call, so several server processes
+    can share the messages.
+
+    Ids come from a counter, one higher than the highest id ever used, so an
+    id is never reused and allocating one is O(1). capacity is the number of
+    messages the store holds, 0 for no limit.
+
+    Every change is passed to the functions in hooks, as (version, type, id,
+    record) with type create, replace, delete or reset (after a reload),
+    while the store is locked. They must be quick.
+
+    With mapped=True the records are not kept in memory, but read from an
+    mmap of the log: messages has the (offset, length) of every record in
+    the log, and get() returns a memoryview slice of the map. New records
+    are kept until remap_at bytes of them are written, then the log is
+    mapped again, so memory use stays flat however big the log grows.
+
+    The records of the cache_size most recently read single messages are
+    kept with their etags in an LRU cache, dropped when the message changes.
+    """
+
+    def __init__(self, path:str = "messages.txt", capacity:int = 0, mapped:bool = False,
+                 remap_at:int = 1 << 20, cache_size:int = 1024, **log_options):
+        self.path = path
+        self.capacity = capacity
+        self.mapped = mapped
+        self.remap_at = remap_at
+        self.cache_size = cache_size
+        self.lock = threading.RLock()
+        self.messages = {}      #id -> b'{"id": <id>,"text": <text>}' or (offset, length), in the order they were written
+        self.versions = {}      #id -> version when the message was written
+        self.ids = []           #sorted ids of the messages
+        self.next_id = 0        #id of the next new message
+        self.listing = None     #cached body for GET /messages
+        self.tag = None         #cached etag of the listing
+        self.cached = OrderedDict()     #id -> (record, etag, modified) of single messages
+        self.version = 0        #of the last change, its position in the log (see wal.py)
+        self.epoch = 0          #times the log was loaded, the versions start again after a load
+        self.modified = time.time()
+        self.hooks = []
+        self.out = bytearray()  #reused to serialize the records of a batch
+        self.view = memoryview(b"")     #of the mapped log
+        self.unmapped = {}      #id -> offset in the log, of records written since the log was mapped
+        self.unmapped_bytes = 0
+        self.generation = 0     #of the log when it was mapped
+        self.log = MessageLog(path, self.lock, self.snapshot, **log_options)
+        self.load()
+
+    def __contains__(self, id:int):
+        with self.log.locked():
+            self.sync()
+            return id in self.messages
+
+    def __len__(self):
+        with self.log.locked():
+            self.sync()
+            return len(self.messages)
+
+    def touch(self, version:int = None):
+        """
+        Note that the messages changed, and drop what was cached for the old
+        ones. version is that of the change, by default the end of the log.
+        """
+
+        self.listing = None
+        self.tag = None
+        self.version = self.log.base + self.log.size if version is None else version
+        self.modified = time.time()
+
+    def changed(self, type:bytes, id:int, record:bytes, version:int = None):
+        """Note a change of a message and tell the hooks about it."""
+
+        self.touch(version)
+        if id is None:
+            self.cached.clear()
+        else:
+            self.cached.pop(id, None)
+        for hook in self.hooks:
+            hook(self.version, type, id, record)
+
+    def refresh(self):
+        """Catch up with the file and return the current version."""
+
+        with self.log.locked():
+            self.sync()
+            return self.version
+
+    def stamp(self):
+        """
+        Catch up with the file and return (epoch, version), which is never
+        the same for different messages, also if the file was replaced.
+        """
+
+        with self.log.locked():
+            self.sync()
+            return self.epoch, self.version
+
+    def sync(self):
+        """Catch up with the file if it was changed behind our back."""
+
+        if self.mapped and (self.unmapped_bytes >= self.remap_at
+                            or self.generation != self.log.generation):
+            self.remap()
+
+        if not self.log.changed():
+            return
+
+        tail = self.log.read_tail()
+        if tail is None:
+            self.load()
+            return
+
+        valid = 0
+        base = self.log.size
+        for id, record, valid in records(tail):
+            if id is None or id == mark_id:
+                continue
+            version = self.log.base + base + valid
+            existed = id in self.messages
+            if existed:
+                self.remove(id)
+            if record is not None:
+                self.insert(id, record, base + valid - len(record), version)
+            self.next_id = max(self.next_id, id + 1)
+            if existed or record is not None:
+                self.changed(b"delete" if record is None else b"replace" if existed else b"create",
+                             id, record, version)
+
+        self.log.advance(valid, len(tail))
+
+    def load(self):
+        """Replay the message log into memory and restart the id counter after the highest id."""
+
+        self.versions = {}
+        self.epoch += 1
+        self.messages, top = self.log.load(self.mapped, self.versions)
+        if self.mapped:
+            self.unmapped = {}
+            self.remap()
+        self.ids = sorted(self.messages)
+        self.next_id = top + 1
+        self.changed(b"reset", None, None)
+
+    def remap(self):
+        """Map the log again, and point the messages written since the last time into the map."""
+
+        data = self.log.map()
+        if self.generation != self.log.generation:
+            #the log was compacted, every record moved
+            index = replay(data, spans=True)[0]
+            for id in self.messages:
+                self.messages[id] = index[id]
+            self.generation = self.log.generation
+        else:
+            for id, offset in self.unmapped.items():
+                self.messages[id] = (offset, len(self.messages[id]))
+
+        #slices of the old map in use keep it alive until they are dropped
+        self.view = memoryview(data)
+        self.unmapped.clear()
+        self.unmapped_bytes = 0
+
+    def get(self, id:int):
+        """Return the record of a message."""
+
+        record = self.messages[id]
+        if type(record) is tuple:
+            offset, length = record
+            return self.view[offset:offset + length]
+        return record
+
+    def values(self):
+        """Return the records of all messages, in the order they were written."""
+
+        if self.mapped:
+            return [self.get(x) for x in self.messages]
+        return self.messages.values()
+
+    def insert(self, id:int, record:bytes, offset:int = None, version:int = None):
+        """
+        Put a message in memory, last in the listing, with the version of
+        its record, by default the end of the log. offset is where record is
+        in the log, for mapped stores.
+        """
+
+        self.messages[id] = record
+        self.versions[id] = self.log.base + self.log.size if version is None else version
+        bisect.insort(self.ids, id)
+        if self.mapped:
+            self.unmapped[id] = offset
+            self.unmapped_bytes += len(record)
+
+    def remove(self, id:int):
+        self.unmapped.pop(id, None)
+        del self.messages[id]
+        del self.versions[id]
+        del self.ids[bisect.bisect_left(self.ids, id)]
+
+    def snapshot(self):
+        """Return every message as log records, for compaction of the log."""
+
+        self.sync()
+        snapshot = b"".join(b"," + x for x in self.values())
+        if self.next_id - 1 not in self.messages and self.next_id:
+            #keep the highest id in the log, deleted, so it is not used again
+            snapshot = b',{"id": ' + str(self.next_id - 1).encode() + b'}' + snapshot
+        return snapshot
+
+    def flush(self):
+        """Force every change to disk."""
+
+        with self.log.locked():
+            self.log.flush()
+
+    def add(self, message:Message):
+        """
+        Store message as a new message and return its record, or None
+        if the store is full. The id of message is set to the new id. Raises
+        OSError if the log can not be written, and then nothing is stored.
+        """
+
+        with self.log.locked():
+            self.sync()
+            if self.capacity and len(self.messages) >= self.capacity:
+                return None
+
+            id = message.id = self.next_id
+            record = message.record()
+            offset = self.log.size + 1
+            self.log.append(b"," + record)
+            self.next_id += 1
+            self.insert(id, record, offset)
+            self.changed(b"create", id, record)
+
+            return record
+
+    def replace(self, message:Message):
+        """Replace the message with the id of message and return the new record, or None if it does not exist."""
+
+        with self.log.locked():
+            self.sync()
+            id = message.id
+            if id not in self.messages:
+                return None
+
+            #a replaced message is moved to the end, like a delete and add
+            record = message.record()
+            offset = self.log.size + 1
+            self.log.append(b"," + record)
+            self.remove(id)
+            self.insert(id, record, offset)
+            self.changed(b"replace", id, record)
+
+            return record
+
+    def delete(self, id:int):
+        """Remove the message with the given id. Return False if it did not exist."""
+
+        with self.log.locked():
+            self.sync()
+            if id not in self.messages:
+                return False
+
+            self.log.append(b',{"id": ' + str(id).encode() + b'}')
+            self.remove(id)
+            self.changed(b"delete", id, None)
+
+            return True
+
+    def batch(self, operations:list):
+        """
+        Apply a list of operations, (type, Message) with type b"create",
+        b"replace" or b"delete", all or none of them, with one write to the
+        log. The ids of the created messages are set.
+
+        Return (True, results) where results has the new record of every
+        create and replace and None for every delete, or (False, results)
+        where results has the status code of every operation that can not be
+        done (404 for a missing id, 507 for a full store) and None for the rest.
+        """
+
+        with self.log.locked():
+            self.sync()
+
+            #check every operation against the messages as they would be
+            present = set()
+            gone = set()
+            count = len(self.messages)
+            next_id = self.next_id
+            errors = []
+            for type, message in operations:
+                error = None
+                id = message.id
+                if type == b"create":
+                    if self.capacity and count >= self.capacity:
+                        error = 507
+                    else:
+                        id = next_id
+                        next_id += 1
+                        present.add(id)
+                        count += 1
+                elif id in gone or not (id in self.messages or id in present):
+                    error = 404
+                elif type == b"delete":
+                    gone.add(id)
+                    count -= 1
+                errors.append(error)
+
+            if any(errors):
+                return False, errors
+            if not operations:
+                return True, []
+
+            #serialize every record into the reused buffer, and write it at once
+            out = self.out
+            out.clear()
+            out += b',{"id": %d,"batch": %d}' % (batch_id, len(operations))
+            spans = []
+            id = self.next_id
+            for type, message in operations:
+                if type == b"create":
+                    message.id = id
+                    id += 1
+                out += b","
+                start = len(out)
+                if type == b"delete":
+                    out += b'{"id": %d}' % message.id
+                else:
+                    message.write(out)
+                spans.append((start, len(out)))
+
+            base = self.log.size
+            self.log.append(out)
+            with memoryview(out) as view:
+                planned = [(type, message.id, None if type == b"delete" else bytes(view[start:end]), start)
+                           for (type, message), (start, end) in zip(operations, spans)]
+
+            self.next_id = next_id
+            for (type, id, record, start), (_, end) in zip(planned, spans):
+                version = self.log.base + base + end
+                if type != b"create":
+                    self.remove(id)
+                if record is not None:
+                    self.insert(id, record, base + start, version)
+                self.changed(type, id, record, version)
+
+            return True, [record for type, id, record, start in planned]
+
+    def tagged(self):
+        """
+        Return the listing with its etag and the time it was last modified.
+        The etag is a hash of the listing, so it only changes when the
+        messages do, and is the same in every process sharing the messages.
+        """
+
+        with self.log.locked():
+            listing = self.get_all()
+            if self.tag is None:
+                self.tag = b'"' + blake2b(listing, digest_size=12).hexdigest().encode() + b'"'
+
+            return listing, self.tag, self.modified
+
+    def lookup(self, id:int):
+        """
+        Return the record of a message with its etag and the time it was
+        last modified, or None if there is no such message. Like the etag
+        of the listing, the etag is a hash of the record.
+        """
+
+        with self.log.locked():
+            self.sync()
+            entry = self.cached.get(id)
+            if entry is not None:
+                self.cached.move_to_end(id)
+                return entry
+
+            if id not in self.messages:
+                return None
+
+            record = bytes(self.get(id))
+            entry = (record, b'"' + blake2b(record, digest_size=12).hexdigest().encode() + b'"',
+                     self.modified)
+            self.cached[id] = entry
+            if len(self.cached) > self.cache_size:
+                self.cached.popitem(last=False)
+            return entry
+
+    def query(self, after_id:int = None, since:int = None, limit:int = None):
+        """
+        Return a list of the records of the messages that match, and the
+        version the result is complete up to. With after_id, the messages
+        with a higher id are listed by id, otherwise the messages are listed
+        in the order they were written. With since, only the messages
+        written after that version are listed. At most limit are listed.
+
+        The records are not joined, so a big result can be sent in pieces.
+        A since ahead of the store is from before the log was replaced, then
+        every message is listed.
+        """
+
+        with self.log.locked():
+            self.sync()
+            if since is not None and since > self.version:
+                since = None
+            if after_id is not None:
+                ids = self.ids[bisect.bisect_right(self.ids, after_id):]
+                if since is not None:
+                    ids = [x for x in ids if self.versions[x] > since]
+            elif since is not None:
+                #the versions grow in the order of the messages, walk back to since
+                ids = []
+                for id in reversed(self.messages):
+                    if self.versions[id] <= since:
+                        break
+                    ids.append(id)
+                ids.reverse()
+            else:
+                ids = list(self.messages)
+
+            version = self.version
+            if limit is not None and len(ids) > limit:
+                ids = ids[:limit]
+                if after_id is None:
+                    version = self.versions[ids[-1]] if ids else since or 0
+
+            return [self.get(x) for x in ids], version
+
+    def get_all(self):
+        """Return all messages as a json formated list."""
+
+        with self.log.locked():
+            self.sync()
+            if self.listing is None:
+                self.listing = b"[" + b",".join(self.values()) + b"]"
+
+            return self.listing
@@ -3,10 +3,29 @@ from pydoc import cli
 import socketserver
 import threading
 from server import MyTCPHandler as HTTPHandler
+from aio import HTTPProtocol
+import asyncio
+from wal import replay
+from store import MessageStore
+from events import Events
+from message import Message
+from appendfile import AppendFile
 from http import HTTPStatus
 from http.client import HTTPConnection, BadStatusLine
 import os
+import re
+import signal
 from random import shuffle
+import gzip
+import json
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import servers
+from admission import Admission
 
 """
 Written by: Raymon Skjørten Hansen
@@ -28,16 +47,57 @@ with open("src/index.html", "rb") as infile:
 with open("src/server.py", "rb") as infile:
     FORBIDDEN_BODY = infile.read()
 
+with open("src/favicon.ico", "rb") as infile:
+    FAVICON_BODY = infile.read()
+
 
 class MockServer(socketserver.TCPServer):
     allow_reuse_address = True
 
 
+def stored_messages(testfile):
+    """Return the messages in the message log, as they are after a replay."""
+    with open(testfile, "rb") as infile:
+        messages = replay(infile.read())[0]
+    return b"".join(b"," + x for x in messages.values())
+
+
+def start_server(*args):
+    """Start server.py in a process of its own, in a new directory, and return the process, its port and the directory."""
+    directory = tempfile.mkdtemp()
+    with socket.socket() as probe:
+        probe.bind((HOST, 0))
+        port = probe.getsockname()[1]
+
+    process = subprocess.Popen([sys.executable, os.path.abspath("src/server.py"), "--port", str(port),
+                                "--root", os.path.abspath("src"), "--drain-timeout", "2"] + list(args),
+                               cwd=directory, stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((HOST, port), timeout=1).close()
+            break
+        except OSError:
+            time.sleep(0.05)
+    return process, port, directory
+
+
+def stop_server(process, directory):
+    process.terminate()
+    process.wait(10)
+    shutil.rmtree(directory)
+
+
 server = MockServer((HOST, PORT), HTTPHandler)
 server_thread = threading.Thread(target=server.serve_forever)
 server_thread.start()
 client = HTTPConnection(HOST, PORT)
 
+AIO_PORT = PORT + 1
+aio_loop = asyncio.new_event_loop()
+aio_loop.run_until_complete(aio_loop.create_server(HTTPProtocol, HOST, AIO_PORT, reuse_address=True))
+threading.Thread(target=aio_loop.run_forever, daemon=True).start()
+
 
 def server_returns_valid_response_code():
     """Server returns a valid http-response code."""
@@ -105,6 +165,15 @@ def test_valid_content_type():
         client.close()
 
 
+def test_gzip_content_encoding():
+    """GET-request accepting gzip returns the compressed index."""
+    client.request("GET", "/", headers={"Accept-Encoding": "gzip"})
+    response = client.getresponse()
+    body = response.read()
+    client.close()
+    return response.getheader("Content-Encoding") == "gzip" and gzip.decompress(body) == EXPECTED_BODY
+
+
 def test_nonexistent_resource_status_code():
     """Server returns 404 on non-existing resource."""
     client.request("GET", "did_not_find_this_file.not")
@@ -129,6 +198,262 @@ def test_directory_traversal_exploit():
     return response.status == HTTPStatus.FORBIDDEN
 
 
+def test_static_file():
+    """GET-request to a static file returns the file with its content type."""
+    client.request("GET", "/favicon.ico")
+    response = client.getresponse()
+    body = response.read()
+    client.close()
+    return body == FAVICON_BODY and response.getheader("Content-Type") == "image/vnd.microsoft.icon"
+
+
+def test_slow_request_head():
+    """A request head that is not complete within the header timeout is answered with 408."""
+
+    HTTPHandler.header_timeout = 0.3
+    try:
+        slow = socket.create_connection((HOST, PORT), timeout=5)
+        slow.sendall(b"GET / HTTP/1.1\r\n")
+        time.sleep(0.2)
+        slow.sendall(b"Host: localhost\r\n")
+        response = slow.recv(1 << 16)
+        slow.close()
+    finally:
+        del HTTPHandler.header_timeout
+
+    return response.startswith(b"HTTP/1.1 408 ")
+
+
+def test_threaded_server():
+    """The threaded server answers connections at the same time, with a fixed pool of worker threads."""
+
+    server = servers.PooledTCPServer((HOST, 0), HTTPHandler, 2, 4)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    port = server.server_address[1]
+    try:
+        #the first connection is kept alive, and holds a worker while the second is answered
+        first = HTTPConnection(HOST, port, timeout=5)
+        second = HTTPConnection(HOST, port, timeout=5)
+        first.request("GET", "/")
+        first_test = first.getresponse().read() == EXPECTED_BODY
+        second.request("GET", "/")
+        second_test = second.getresponse().read() == EXPECTED_BODY
+        first.close()
+        second.close()
+        third_test = len(server.workers) == 2 and all(x.is_alive() for x in server.workers)
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+    if not first_test:
+        print("failed first test")
+    if not second_test:
+        print("failed second test")
+    if not third_test:
+        print("failed third test")
+
+    return first_test and second_test and third_test
+
+
+def RESTful_prefork_store_test():
+    """Prefork workers share the messages: a message posted to any of them gets a new id, and every one lists them all."""
+
+    process, port, directory = start_server("--mode", "prefork", "--workers", "3")
+
+    def post(i):
+        connection = HTTPConnection(HOST, port, timeout=10)
+        msg = b'{"text": "Message %d"}' % i
+        connection.request("POST", "/messages", body=msg, headers={"Content-Length": len(msg)})
+        connection.getresponse().read()
+        connection.close()
+
+    def get():
+        connection = HTTPConnection(HOST, port, timeout=10)
+        connection.request("GET", "/messages")
+        body = connection.getresponse().read()
+        connection.close()
+        return tuple(sorted(x["id"] for x in json.loads(body)))
+
+    try:
+        #a new connection for every request, so they go to different workers
+        posters = [threading.Thread(target=post, args=(i,)) for i in range(30)]
+        for poster in posters:
+            poster.start()
+        for poster in posters:
+            poster.join()
+
+        first_test = {get() for _ in range(10)} == {tuple(range(30))}
+    finally:
+        stop_server(process, directory)
+
+    return first_test
+
+
+def test_admission_refuses():
+    """Connections over --max-connections or --max-per-client are answered with 503 at once, and counted."""
+
+    results = []
+    refused = HTTPHandler.metrics.connections_refused
+    for admission in (Admission(max_connections=1, metrics=HTTPHandler.metrics),
+                      Admission(per_client=1, metrics=HTTPHandler.metrics)):
+        HTTPHandler.admission = admission
+        server = servers.PooledTCPServer((HOST, 0), HTTPHandler, 2, 4)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        port = server.server_address[1]
+        try:
+            #the first connection is kept alive, so the second one is over the limit
+            first = HTTPConnection(HOST, port, timeout=5)
+            first.request("GET", "/")
+            results.append(first.getresponse().status == HTTPStatus.OK)
+            with socket.create_connection((HOST, port), timeout=5) as second:
+                results.append(second.recv(1024).startswith(b"HTTP/1.1 503 "))
+            first.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+            del HTTPHandler.admission
+
+    first_test = all(results)
+    second_test = HTTPHandler.metrics.connections_refused - refused == 2
+
+    if not first_test:
+        print("failed first test")
+    if not second_test:
+        print("failed second test")
+
+    return first_test and second_test
+
+
+def test_backlog_policy():
+    """With every worker busy and the backlog full, a new connection gets 503 with reject, and waits with wait."""
+
+    results = []
+    for policy in ("reject", "wait"):
+        server = servers.PooledTCPServer((HOST, 0), HTTPHandler, 1, 1, policy)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        port = server.server_address[1]
+        try:
+            #the kept alive connection holds the only worker, the next one fills the backlog
+            busy = HTTPConnection(HOST, port, timeout=5)
+            busy.request("GET", "/")
+            busy.getresponse().read()
+            queued = socket.create_connection((HOST, port), timeout=5)
+            time.sleep(0.2)
+            extra = socket.create_connection((HOST, port), timeout=0.5)
+            if policy == "reject":
+                results.append(extra.recv(1024).startswith(b"HTTP/1.1 503 "))
+            else:
+                extra.sendall(b"GET / HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n")
+                try:
+                    extra.recv(1024)
+                    results.append(False)
+                except socket.timeout:
+                    results.append(True)
+                #once the worker is free, the waiting connection is served
+                queued.close()
+                busy.close()
+                extra.settimeout(5)
+                results.append(extra.recv(1024).startswith(b"HTTP/1.1 200 "))
+            extra.close()
+            queued.close()
+            busy.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+    first_test = all(results)
+    if not first_test:
+        print("failed first test")
+
+    return first_test
+
+
+def test_reload_hands_over():
+    """SIGHUP starts a new server process on the same socket without refusing a request, and the old one exits."""
+
+    process, port, directory = start_server()
+
+    def request(method, uri, msg=b""):
+        connection = HTTPConnection(HOST, port, timeout=5)
+        connection.request(method, uri, body=msg, headers={"Content-Length": len(msg)})
+        response = connection.getresponse()
+        body = response.read()
+        connection.close()
+        return response.status, body
+
+    def pid():
+        return int(re.search(rb'pid="(\d+)"', request("GET", "/metrics")[1]).group(1))
+
+    new_pid = None
+    try:
+        request("POST", "/messages", b'{"text": "Before"}')
+        process.send_signal(signal.SIGHUP)
+        #requests keep being answered while the new process starts and the old one drains
+        statuses = []
+        deadline = time.monotonic() + 10
+        while process.poll() is None and time.monotonic() < deadline:
+            statuses.append(request("GET", "/")[0])
+            time.sleep(0.05)
+
+        first_test = process.poll() == 0 and len(statuses) > 0 and all(x == HTTPStatus.OK for x in statuses)
+        new_pid = pid()
+        second_test = new_pid != process.pid
+        request("POST", "/messages", b'{"text": "After"}')
+        third_test = [x["id"] for x in json.loads(request("GET", "/messages")[1])] == [0, 1]
+    finally:
+        if new_pid is not None:
+            os.kill(new_pid, signal.SIGTERM)
+        stop_server(process, directory)
+
+    if not first_test:
+        print("failed first test")
+    if not second_test:
+        print("failed second test")
+    if not third_test:
+        print("failed third test")
+
+    return first_test and second_test and third_test
+
+
+def test_draining_closes_connections():
+    """While the server drains, a response closes its connection instead of keeping it alive."""
+
+    HTTPHandler.draining = True
+    try:
+        client.request("GET", "/")
+        response = client.getresponse()
+        response.read()
+        client.close()
+    finally:
+        del HTTPHandler.draining
+
+    return response.status == 200 and response.getheader("Connection") == "close"
+
+
+def test_metrics_endpoint():
+    """GET /metrics returns the request counters and latency histograms in Prometheus format."""
+    client.request("GET", "/")
+    client.getresponse().read()
+    client.close()
+
+    client.request("GET", "/metrics")
+    response = client.getresponse()
+    body = response.read()
+    client.close()
+    pid = b'pid="%d"' % os.getpid()
+    return (response.status == 200
+            and b'http_requests_total{%s,method="GET",route="/",code="200"}' % pid in body
+            and b'http_request_duration_seconds_bucket{%s,method="GET",route="/",le="+Inf"}' % pid in body
+            and b"http_active_connections{%s} 1" % pid in body
+            and b"messages_stored{%s}" % pid in body)
+
+
 def test_post_to_non_existing_file_should_create_file():
     """POST-request to non-existing file, should create that file."""
     testfile = "test.txt"
@@ -184,6 +509,93 @@ def test_post_to_test_file_should_return_correct_content_length():
     return expected_content_length == actual_length
 
 
+def test_get_range_of_test_file():
+    """GET to test-file with a Range header returns only those bytes, also when they are sent from the file."""
+    testfile = "test.txt"
+    msg = b'text=Simple test'
+    headers = {
+        "Content-type": "application/x-www-form-urlencoded",
+        "Accept": "text/plain",
+        "Content-Length": len(msg),
+    }
+    if(os.path.exists(testfile)):
+        os.remove(testfile)
+
+    def get(range):
+        client.request("GET", testfile, headers={"Range": range})
+        response = client.getresponse()
+        body = response.read()
+        client.close()
+        return response.status, body
+
+    #a tail of 4 bytes, so most ranges are sent from the file
+    HTTPHandler.test_file = AppendFile(testfile, tail_size=4)
+    try:
+        client.request("POST", testfile, body=msg, headers=headers)
+        client.getresponse().read()
+        client.close()
+        client.request("POST", testfile, body=msg, headers=headers)
+        client.getresponse().read()
+        client.close()
+
+        first_test = get("bytes=%d-" % len(msg)) == (206, msg)
+        second_test = get("bytes=-4") == (206, b"test") and get("bytes=5-10") == (206, b"Simple")
+        third_test = get("bytes=100-")[0] == 416 and get("lines=1-2") == (200, msg + msg)
+        status, body = get("bytes=0-3,-4")
+        fourth_test = (status == 206 and body.count(b"\r\n\r\ntext\r\n") == 1
+                       and body.count(b"\r\n\r\ntest\r\n") == 1)
+    finally:
+        del HTTPHandler.test_file
+
+    return first_test and second_test and third_test and fourth_test
+
+
+def test_get_ranges_of_index():
+    """GET to index.html with a Range header returns the ranges, and the whole file if If-Range does not match."""
+
+    def get(headers):
+        client.request("GET", "/index.html", headers=headers)
+        response = client.getresponse()
+        body = response.read()
+        client.close()
+        return response, body
+
+    response, full = get({})
+    etag = response.getheader("ETag")
+
+    response, body = get({"Range": "bytes=0-9"})
+    first_test = (response.status == 206 and body == full[:10]
+                  and response.getheader("Content-Range") == "bytes 0-9/%d" % len(full))
+
+    response, body = get({"Range": "bytes=0-4,10-14"})
+    second_test = (response.status == 206
+                   and response.getheader("Content-Type").startswith("multipart/byteranges; boundary=")
+                   and b"Content-Range:bytes 0-4/%d\r\n\r\n%s\r\n" % (len(full), full[:5]) in body
+                   and b"Content-Range:bytes 10-14/%d\r\n\r\n%s\r\n" % (len(full), full[10:15]) in body)
+
+    third_test = (get({"Range": "bytes=0-9", "If-Range": '"other"'})[0].status == 200
+                  and get({"Range": "bytes=0-9", "If-Range": etag})[0].status == 206)
+
+    return first_test and second_test and third_test
+
+
+def test_post_chunked_to_test_file():
+    """POST to test-file with a chunked body should append the decoded body."""
+    testfile = "test.txt"
+    chunks = [b'text=Simple ', b'chunked ', b'test']
+    headers = {
+        "Content-type": "application/x-www-form-urlencoded",
+        "Accept": "text/plain",
+        "Transfer-Encoding": "chunked",
+    }
+    if(os.path.exists(testfile)):
+        os.remove(testfile)
+    client.request("POST", testfile, body=iter(chunks), headers=headers, encode_chunked=True)
+    response_body = client.getresponse().read()
+    client.close()
+    return response_body == b''.join(chunks)
+
+
 def RESTful_post_test():
     """POST to messages should create messages file and add msg content to it."""
 
@@ -272,8 +684,7 @@ def RESTful_post_and_put_id_test():
     client.getresponse().read()     #wait for server
     client.close()
 
-    with open(testfile, "rb") as infile:
-        filecontent2 = infile.read()
+    filecontent2 = stored_messages(testfile)
     first_test = filecontent2 == b',' + msg2
 
     if not first_test:
@@ -291,8 +702,7 @@ def RESTful_post_and_put_id_test():
     client.getresponse().read()     #wait for server
     client.close()
 
-    with open(testfile, "rb") as infile:
-        filecontent3 = infile.read()
+    filecontent3 = stored_messages(testfile)
     second_test = filecontent3 == b',{"id": 0,"text": "Third message"}'
 
     if not second_test:
@@ -383,10 +793,7 @@ def RESTful_post_delete_test():
     response = client.getresponse()
     client.close()
 
-    with open(testfile, "rb") as infile:
-        filecontent = infile.read()
-
-    return filecontent == b''
+    return stored_messages(testfile) == b''
 
 def RESTful_get_empty_test():
     """GET to messages with no messages should return 404 not found."""
@@ -438,6 +845,820 @@ def RESTful_get_empty_test():
 
     return first_test and second_test
 
+def RESTful_delete_appends_to_log_test():
+    """DELETE should append a record to the message log instead of rewriting it."""
+
+    uri = "messages"
+    testfile = "messages.txt"
+
+    if(os.path.exists(testfile)):
+        os.remove(testfile)
+
+    msg1 = b'{"text": "Example text1"}'
+    headers1 = {
+        "Content-type": "application/x-www-form-urlencoded",
+        "Accept": "text/plain",
+        "Content-Length": len(msg1),
+    }
+    client.request("POST", url=uri, body=msg1, headers=headers1)
+    client.getresponse().read()
+    client.close()
+
+    with open(testfile, "rb") as infile:
+        before = infile.read()
+
+    client.request("DELETE", url="messages/0")
+    client.getresponse().read()
+    client.close()
+
+    with open(testfile, "rb") as infile:
+        after = infile.read()
+
+    return after.startswith(before) and stored_messages(testfile) == b''
+
+def RESTful_store_full_test():
+    """POST to a full message store returns 507, and ids of deleted messages are not used again."""
+
+    uri = "messages"
+    testfile = "messages.txt"
+
+    if(os.path.exists(testfile)):
+        os.remove(testfile)
+
+    def post():
+        msg = b'{"text": "Example text"}'
+        headers = {
+            "Content-type": "application/x-www-form-urlencoded",
+            "Accept": "text/plain",
+            "Content-Length": len(msg),
+        }
+        client.request("POST", url=uri, body=msg, headers=headers)
+        response = client.getresponse()
+        body = response.read()
+        client.close()
+        return response.status, body
+
+    HTTPHandler.store.capacity = 2
+    try:
+        post()
+        post()
+        first_test = post()[0] == 507
+
+        msg = b'{"id": 1}'
+        headers = {
+            "Content-type": "application/x-www-form-urlencoded",
+            "Accept": "text/plain",
+            "Content-Length": len(msg),
+        }
+        client.request("DELETE", url=uri, body=msg, headers=headers)
+        client.getresponse().read()
+        client.close()
+
+        status, body = post()
+        second_test = status == 201 and body.startswith(b',{"id": 2,')
+    finally:
+        HTTPHandler.store.capacity = 0
+
+    if not first_test:
+        print("failed first test")
+    if not second_test:
+        print("failed second test")
+
+    return first_test and second_test
+
+
+def RESTful_paginated_get_test():
+    """GET to messages with limit, after_id and since returns a part of the listing, big listings are chunked."""
+
+    uri = "messages"
+    testfile = "messages.txt"
+
+    if(os.path.exists(testfile)):
+        os.remove(testfile)
+
+    for i in range(5):
+        msg = b'{"text": "Message %d"}' % i
+        headers = {
+            "Content-type": "application/x-www-form-urlencoded",
+            "Accept": "text/plain",
+            "Content-Length": len(msg),
+        }
+        client.request("POST", url=uri, body=msg, headers=headers)
+        client.getresponse().read()
+        client.close()
+        if i == 2:
+            client.request("GET", url=uri + "?since=0")
+            response = client.getresponse()
+            response.read()
+            client.close()
+            version = response.getheader("X-Messages-Version")
+
+    client.request("GET", url=uri + "?limit=2")
+    first_test = [x["id"] for x in json.loads(client.getresponse().read())] == [0, 1]
+    client.close()
+
+    client.request("GET", url=uri + "?after_id=1&limit=2")
+    second_test = [x["id"] for x in json.loads(client.getresponse().read())] == [2, 3]
+    client.close()
+
+    client.request("GET", url=uri + "?since=" + version)
+    third_test = [x["id"] for x in json.loads(client.getresponse().read())] == [3, 4]
+    client.close()
+
+    HTTPHandler.stream_at = 2
+    try:
+        client.request("GET", url=uri)
+        response = client.getresponse()
+        body = response.read()
+        client.close()
+    finally:
+        del HTTPHandler.stream_at
+    fourth_test = (response.getheader("Transfer-Encoding") == "chunked"
+                   and [x["id"] for x in json.loads(body)] == [0, 1, 2, 3, 4])
+
+    if not first_test:
+        print("failed first test")
+    if not second_test:
+        print("failed second test")
+    if not third_test:
+        print("failed third test")
+    if not fourth_test:
+        print("failed fourth test")
+
+    return first_test and second_test and third_test and fourth_test
+
+
+def test_asyncio_engine():
+    """The asyncio engine routes requests like MyTCPHandler."""
+
+    aio_client = HTTPConnection(HOST, AIO_PORT)
+    aio_client.request("GET", "/")
+    response = aio_client.getresponse()
+    first_test = response.status == HTTPStatus.OK and response.read() == EXPECTED_BODY
+    aio_client.close()
+
+    aio_client.request("GET", "did_not_find_this_file.not")
+    second_test = aio_client.getresponse().status == HTTPStatus.NOT_FOUND
+    aio_client.close()
+
+    #a file is sent a few bytes at a time, and the next response after it
+    HTTPProtocol.test_file = AppendFile("test.txt", tail_size=4)
+    HTTPProtocol.file_chunk = 3
+    try:
+        with open("test.txt", "wb") as outfile:
+            outfile.write(b"Sent from the file, a chunk at a time")
+        aio_client.request("GET", "/test.txt")
+        body = aio_client.getresponse().read()
+        aio_client.request("GET", "/")
+        third_test = (body == b"Sent from the file, a chunk at a time"
+                      and aio_client.getresponse().read() == EXPECTED_BODY)
+        aio_client.close()
+    finally:
+        HTTPProtocol.test_file.file.close()
+        del HTTPProtocol.test_file
+        del HTTPProtocol.file_chunk
+
+    return first_test and second_test and third_test
+
+def RESTful_braces_in_text_test():
+    """POST to messages with braces in the text stores the message, a text that is not a string is a bad body."""
+
+    uri = "messages"
+    testfile = "messages.txt"
+
+    if(os.path.exists(testfile)):
+        os.remove(testfile)
+
+    msg = b'{"text": "Braces {like} these, and \\"quotes\\""}'
+    headers = {
+        "Content-type": "application/x-www-form-urlencoded",
+        "Accept": "text/plain",
+        "Content-Length": len(msg),
+    }
+    client.request("POST", url=uri, body=msg, headers=headers)
+    response = client.getresponse()
+    response.read()
+    client.close()
+    first_test = (response.status == HTTPStatus.CREATED
+                  and stored_messages(testfile) == b',{"id": 0,"text": "Braces {like} these, and \\"quotes\\""}')
+
+    msg = b'{"text": {"nested": 1}}'
+    headers["Content-Length"] = len(msg)
+    client.request("POST", url=uri, body=msg, headers=headers)
+    response = client.getresponse()
+    response.read()
+    client.close()
+    second_test = response.status == HTTPStatus.BAD_REQUEST
+
+    if not first_test:
+        print("failed first test")
+    if not second_test:
+        print("failed second test")
+
+    return first_test and second_test
+
+
+def RESTful_batch_test():
+    """POST to messages/batch applies all operations or, if one of them fails, none of them."""
+
+    uri = "/messages/batch"
+    testfile = "messages.txt"
+
+    if(os.path.exists(testfile)):
+        os.remove(testfile)
+
+    def batch(operations):
+        msg = json.dumps(operations).encode()
+        headers = {
+            "Content-type": "application/json",
+            "Accept": "text/plain",
+            "Content-Length": len(msg),
+        }
+        client.request("POST", url=uri, body=msg, headers=headers)
+        response = client.getresponse()
+        body = json.loads(response.read())
+        client.close()
+        return response.status, body
+
+    status, results = batch([{"op": "create", "text": "First message"},
+                             {"op": "create", "text": "Second message"},
+                             {"op": "replace", "id": 0, "text": "Replaced message"},
+                             {"op": "delete", "id": 1}])
+    first_test = (status == 200
+                  and [x["status"] for x in results] == [201, 201, 200, 200]
+                  and stored_messages(testfile) == b',{"id": 0,"text": "Replaced message"}')
+
+    status, results = batch([{"op": "create", "text": "Third message"},
+                             {"op": "delete", "id": 7}])
+    second_test = (status == 409
+                   and [x["status"] for x in results] == [424, 404]
+                   and stored_messages(testfile) == b',{"id": 0,"text": "Replaced message"}')
+
+    if not first_test:
+        print("failed first test")
+    if not second_test:
+        print("failed second test")
+
+    return first_test and second_test
+
+
+def RESTful_mapped_store_test():
+    """A store that reads the messages from a map of messages.txt lists the same messages, also after a compaction."""
+
+    uri = "messages"
+    testfile = "messages.txt"
+
+    if(os.path.exists(testfile)):
+        os.remove(testfile)
+
+    def send(method, msg):
+        headers = {
+            "Content-type": "application/x-www-form-urlencoded",
+            "Accept": "text/plain",
+            "Content-Length": len(msg),
+        }
+        client.request(method, url=uri, body=msg, headers=headers)
+        client.getresponse().read()
+        client.close()
+
+    def get():
+        client.request("GET", url=uri)
+        body = client.getresponse().read()
+        client.close()
+        return body
+
+    #remap_at=0 maps the log again before every change is read
+    HTTPHandler.store = MessageStore(testfile, mapped=True, remap_at=0)
+    try:
+        send("POST", b'{"text": "First message"}')
+        send("POST", b'{"text": "Second message"}')
+        send("PUT", b'{"id": 0,"text": "Replaced message"}')
+        send("POST", b'{"text": "Third message"}')
+        send("DELETE", b'{"id": 1}')
+
+        expected = b'[{"id": 0,"text": "Replaced message"},{"id": 2,"text": "Third message"}]'
+        first_test = get() == expected
+
+        HTTPHandler.store.log.compact()
+        send("POST", b'{"text": "Fourth message"}')
+        second_test = get() == expected[:-1] + b',{"id": 3,"text": "Fourth message"}]'
+    finally:
+        HTTPHandler.store.log.close()
+        del HTTPHandler.store
+
+    if not first_test:
+        print("failed first test")
+    if not second_test:
+        print("failed second test")
+
+    return first_test and second_test
+
+
+def RESTful_old_log_test():
+    """A messages.txt with whitespace after the records replays every message and is left as it is."""
+
+    testfile = "messages.txt"
+    old = (b',{"id": 0,"text": "First message"}\n,{"id": 1,"text": "Second message"}\r\n'
+           b',{"id": 2,"text": "Third message"}')
+
+    with open(testfile, "wb") as outfile:
+        outfile.write(old)
+
+    store = MessageStore(testfile)
+    try:
+        first_test = len(store) == 3 and store.get(0) == b'{"id": 0,"text": "First message"}'
+    finally:
+        store.log.close()
+
+    with open(testfile, "rb") as infile:
+        second_test = infile.read() == old
+    os.remove(testfile)
+
+    if not first_test:
+        print("failed first test")
+    if not second_test:
+        print("failed second test")
+
+    return first_test and second_test
+
+
+def RESTful_torn_brace_test():
+    """A messages.txt that ends in a record torn after a brace in its text replays without it, and is truncated."""
+
+    testfile = "messages.txt"
+    whole = b',{"id": 0,"text": "First message"}'
+
+    with open(testfile, "wb") as outfile:
+        outfile.write(whole + b',{"id": 1,"text": "a}')
+
+    store = MessageStore(testfile)
+    try:
+        first_test = len(store) == 1 and json.loads(store.tagged()[0]) == [{"id": 0, "text": "First message"}]
+    finally:
+        store.log.close()
+
+    with open(testfile, "rb") as infile:
+        second_test = infile.read() == whole
+    os.remove(testfile)
+
+    if not first_test:
+        print("failed first test")
+    if not second_test:
+        print("failed second test")
+
+    return first_test and second_test
+
+
+def RESTful_versions_after_restart_test():
+    """Versions of the messages go on where they were after a restart and a compaction, so since still works."""
+
+    testfile = "versions.txt"
+    if(os.path.exists(testfile)):
+        os.remove(testfile)
+
+    store = MessageStore(testfile)
+    for text in (b'"First"', b'"Second"', b'"Third"'):
+        store.add(Message(text=text))
+    store.delete(1)
+    version = store.version
+    store.log.compact()
+    store.log.close()
+
+    #a new process, like after a restart or a reload
+    store = MessageStore(testfile)
+    events = Events(store)
+    try:
+        first_test = store.version == version and store.query(since=version) == ([], version)
+
+        store.add(Message(text=b'"Fourth"'))
+        records, _ = store.query(since=version)
+        second_test = records == [b'{"id": 3,"text": "Fourth"}']
+        third_test = ([x.type for x in events.since(version)] == [b"create"]
+                      and [x.type for x in events.since(version - 1)] == [b"reset"]
+                      and [x.type for x in events.since(store.version + 1)] == [b"reset"])
+    finally:
+        store.log.close()
+        os.remove(testfile)
+
+    if not first_test:
+        print("failed first test")
+    if not second_test:
+        print("failed second test")
+    if not third_test:
+        print("failed third test")
+
+    return first_test and second_test and third_test
+
+
+def RESTful_get_one_test():
+    """GET to messages/<id> returns that message with an ETag, and the new text after a PUT."""
+
+    uri = "/messages"
+    testfile = "messages.txt"
+
+    if(os.path.exists(testfile)):
+        os.remove(testfile)
+
+    def send(method, msg):
+        headers = {
+            "Content-type": "application/x-www-form-urlencoded",
+            "Accept": "text/plain",
+            "Content-Length": len(msg),
+        }
+        client.request(method, url=uri, body=msg, headers=headers)
+        client.getresponse().read()
+        client.close()
+
+    def get(id, headers={}):
+        client.request("GET", url=uri + "/" + str(id), headers=headers)
+        response = client.getresponse()
+        body = response.read()
+        client.close()
+        return response.status, response.getheader("ETag"), body
+
+    send("POST", b'{"text": "First message"}')
+    send("POST", b'{"text": "Second message"}')
+
+    status, etag, body = get(1)
+    first_test = status == 200 and body == b'{"id": 1,"text": "Second message"}'
+    second_test = get(1, {"If-None-Match": etag})[0] == 304
+
+    send("PUT", b'{"id": 1,"text": "Replaced message"}')
+    status, new_etag, body = get(1)
+    third_test = (status == 200 and new_etag != etag
+                  and body == b'{"id": 1,"text": "Replaced message"}')
+
+    send("DELETE", b'{"id": 1}')
+    fourth_test = get(1)[0] == 404 and get("first")[0] == 400
+
+    if not first_test:
+        print("failed first test")
+    if not second_test:
+        print("failed second test")
+    if not third_test:
+        print("failed third test")
+    if not fourth_test:
+        print("failed fourth test")
+
+    return first_test and second_test and third_test and fourth_test
+
+
+def RESTful_response_cache_test():
+    """A GET is answered from the response cache, by encoding, until the messages change."""
+
+    uri = "/messages"
+    testfile = "messages.txt"
+
+    if(os.path.exists(testfile)):
+        os.remove(testfile)
+
+    def send(method, msg):
+        client.request(method, url=uri, body=msg, headers={"Content-Length": len(msg)})
+        client.getresponse().read()
+        client.close()
+
+    def get(headers={}):
+        client.request("GET", url=uri + "/0", headers=headers)
+        response = client.getresponse()
+        body = response.read()
+        client.close()
+        if response.getheader("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        return response.status, response.getheader("ETag"), body
+
+    send("POST", b'{"text": "First message"}')
+    first = get()
+    first_test = get() == first and first[2] == b'{"id": 0,"text": "First message"}'
+    first_test &= ("messages_version", b"/messages/0", None) in HTTPHandler.response_cache.entries
+
+    zipped = get({"Accept-Encoding": "gzip"})
+    second_test = zipped == get({"Accept-Encoding": "gzip"}) and zipped[2] == first[2]
+
+    #a new log starts over at the version of the first message, with another message
+    os.remove(testfile)
+    send("POST", b'{"text": "Fresh message"}')
+    third_test = get()[2] == b'{"id": 0,"text": "Fresh message"}'
+
+    send("PUT", b'{"id": 0,"text": "Replaced message"}')
+    fourth_test = get()[2] == b'{"id": 0,"text": "Replaced message"}'
+
+    if not first_test:
+        print("failed first test")
+    if not second_test:
+        print("failed second test")
+    if not third_test:
+        print("failed third test")
+    if not fourth_test:
+        print("failed fourth test")
+
+    return first_test and second_test and third_test and fourth_test
+
+
+def RESTful_path_id_test():
+    """PUT and DELETE to /messages/<id> change the message with the id in the path, with the auth token if one is set."""
+
+    uri = "/messages"
+    testfile = "messages.txt"
+
+    if(os.path.exists(testfile)):
+        os.remove(testfile)
+
+    def send(method, url, msg, headers={}):
+        headers = dict(headers, **{
+            "Content-type": "application/x-www-form-urlencoded",
+            "Accept": "text/plain",
+            "Content-Length": len(msg),
+        })
+        client.request(method, url=url, body=msg, headers=headers)
+        response = client.getresponse()
+        response.read()
+        client.close()
+        return response.status
+
+    send("POST", uri, b'{"text": "First message"}')
+    send("POST", uri, b'{"text": "Second message"}')
+    first_test = (send("PUT", uri + "/0", b'{"text": "Replaced message"}') == 200
+                  and send("DELETE", uri + "/1", b"") == 200
+                  and stored_messages(testfile) == b',{"id": 0,"text": "Replaced message"}')
+
+    HTTPHandler.auth_token = b"secret"
+    HTTPHandler.build()
+    try:
+        second_test = (send("DELETE", uri + "/0", b"") == 401
+                       and send("DELETE", uri + "/0", b"", {"Authorization": "Bearer secret"}) == 200
+                       and stored_messages(testfile) == b"")
+    finally:
+        del HTTPHandler.auth_token
+        HTTPHandler.build()
+
+    if not first_test:
+        print("failed first test")
+    if not second_test:
+        print("failed second test")
+
+    return first_test and second_test
+
+
+def RESTful_long_poll_test():
+    """GET to messages with wait returns when a message is added, or empty when the wait is over."""
+
+    uri = "/messages"
+    testfile = "messages.txt"
+
+    if(os.path.exists(testfile)):
+        os.remove(testfile)
+
+    client.request("GET", url=uri + "?since=0")
+    version = client.getresponse().getheader("X-Messages-Version")
+    client.close()
+
+    started = time.monotonic()
+    client.request("GET", url=uri + "?wait=0.2&since=" + version)
+    response = client.getresponse()
+    first_test = response.read() == b"[]" and time.monotonic() - started >= 0.2
+    client.close()
+
+    #wait on the asyncio engine while the message is posted to the other one
+    result = {}
+    def poll():
+        aio_client = HTTPConnection(HOST, AIO_PORT)
+        aio_client.request("GET", uri + "?wait=10&since=" + version)
+        result["body"] = aio_client.getresponse().read()
+        aio_client.close()
+    poller = threading.Thread(target=poll)
+    poller.start()
+    time.sleep(0.1)
+
+    msg = b'{"text": "Example text"}'
+    headers = {
+        "Content-type": "application/x-www-form-urlencoded",
+        "Accept": "text/plain",
+        "Content-Length": len(msg),
+    }
+    started = time.monotonic()
+    client.request("POST", url=uri, body=msg, headers=headers)
+    client.getresponse().read()
+    client.close()
+    poller.join(5)
+
+    second_test = (result.get("body") == b'[{"id": 0,"text": "Example text"}]'
+                   and time.monotonic() - started < 5)
+
+    if not first_test:
+        print("failed first test")
+    if not second_test:
+        print("failed second test")
+
+    return first_test and second_test
+
+
+def test_asyncio_body_too_large():
+    """The asyncio engine answers a body too large for a route that reads it into memory with 413, before it arrives."""
+
+    results = []
+    for head in (b"Content-Length: %d" % (64 << 20), b"Transfer-Encoding: chunked"):
+        upload = socket.create_connection((HOST, AIO_PORT), timeout=5)
+        upload.sendall(b"POST /messages HTTP/1.1\r\nHost: localhost\r\n" + head + b"\r\n\r\n")
+        if b"chunked" in head:
+            #only a part of the chunk, so the server has read all that is sent when it answers
+            upload.sendall(b"%x\r\n" % (2 << 20) + b"x" * ((1 << 20) + (1 << 16)))
+        results.append(upload.recv(1024).startswith(b"HTTP/1.1 413 "))
+        upload.close()
+
+    return all(results)
+
+
+def RESTful_long_poll_reads_ahead_test():
+    """While a long poll holds an asyncio connection, no more than max_head bytes sent after it are buffered."""
+
+    poll = socket.create_connection((HOST, AIO_PORT), timeout=5)
+    poll.sendall(b"GET /messages?wait=2 HTTP/1.1\r\nHost: localhost\r\n\r\n")
+    time.sleep(0.2)
+
+    def flood():
+        try:
+            poll.sendall(b"x" * (32 << 20))
+        except OSError:
+            pass
+    flooder = threading.Thread(target=flood)
+    flooder.start()
+    time.sleep(1)
+
+    polling = [x for x in list(HTTPProtocol.connections) if x.waiting]
+    buffered = max(len(x.parser.buffer) for x in polling)
+    poll.shutdown(socket.SHUT_RDWR)
+    poll.close()
+    flooder.join()
+
+    #the server does not read, it notices the client is gone when the long poll is answered
+    deadline = time.monotonic() + 5
+    while polling[0] in HTTPProtocol.connections and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+    #one read of the transport may come after the limit
+    return buffered <= HTTPProtocol.max_head + (1 << 18)
+
+
+def RESTful_blocking_slots_test():
+    """Long polls and event streams over the blocking slots of the socketserver engine get 503, the rest are served."""
+
+    HTTPHandler.blocking_slots = threading.Semaphore(0)
+    try:
+        client.request("GET", "/messages?wait=10")
+        response = client.getresponse()
+        response.read()
+        first_test = response.status == HTTPStatus.SERVICE_UNAVAILABLE
+        client.close()
+
+        client.request("GET", "/messages/events")
+        response = client.getresponse()
+        response.read()
+        second_test = response.status == HTTPStatus.SERVICE_UNAVAILABLE
+        client.close()
+
+        #the slot is given back after the long poll
+        HTTPHandler.blocking_slots = threading.Semaphore(1)
+        client.request("GET", "/messages?wait=0.1")
+        response = client.getresponse()
+        response.read()
+        #the handler gives it back right after the response, maybe after it is read here
+        third_test = response.status == HTTPStatus.OK and HTTPHandler.blocking_slots.acquire(timeout=1)
+        client.close()
+    finally:
+        del HTTPHandler.blocking_slots
+
+    if not first_test:
+        print("failed first test")
+    if not second_test:
+        print("failed second test")
+    if not third_test:
+        print("failed third test")
+
+    return first_test and second_test and third_test
+
+
+def RESTful_events_test():
+    """GET to messages/events streams the created, replaced and deleted messages as server-sent events."""
+
+    uri = "/messages"
+    testfile = "messages.txt"
+
+    if(os.path.exists(testfile)):
+        os.remove(testfile)
+
+    events = socket.create_connection((HOST, AIO_PORT), timeout=5)
+    events.sendall(b"GET /messages/events HTTP/1.1\r\nHost: localhost\r\n\r\n")
+    received = events.recv(4096)
+    while b"retry: 1000" not in received:
+        received += events.recv(4096)
+
+    for method, msg in ((b"POST", b'{"text": "Example text"}'),
+                        (b"PUT", b'{"id": 0,"text": "Other text"}'),
+                        (b"DELETE", b'{"id": 0}')):
+        headers = {
+            "Content-type": "application/x-www-form-urlencoded",
+            "Accept": "text/plain",
+            "Content-Length": len(msg),
+        }
+        client.request(method.decode(), url=uri, body=msg, headers=headers)
+        client.getresponse().read()
+        client.close()
+
+    try:
+        while b"event: delete" not in received:
+            received += events.recv(4096)
+    except socket.timeout:
+        pass
+    events.close()
+
+    return (b'text/event-stream' in received
+            and b'event: create\ndata: {"id": 0,"text": "Example text"}\n' in received
+            and b'event: replace\ndata: {"id": 0,"text": "Other text"}\n' in received
+            and b'event: delete\ndata: {"id": 0}\n' in received)
+
+
+def RESTful_conditional_get_test():
+    """GET to messages with the ETag of the listing returns 304 until the messages change."""
+
+    uri = "messages"
+    testfile = "messages.txt"
+
+    if(os.path.exists(testfile)):
+        os.remove(testfile)
+
+    client.request("GET", url=uri)
+    etag = client.getresponse().getheader("ETag")
+    client.close()
+
+    client.request("GET", url=uri, headers={"If-None-Match": etag})
+    response = client.getresponse()
+    first_test = response.status == HTTPStatus.NOT_MODIFIED and response.read() == b''
+    client.close()
+
+    msg = b'{"text": "Example text"}'
+    headers = {
+        "Content-type": "application/x-www-form-urlencoded",
+        "Accept": "text/plain",
+        "Content-Length": len(msg),
+    }
+    client.request("POST", url=uri, body=msg, headers=headers)
+    client.getresponse().read()
+    client.close()
+
+    client.request("GET", url=uri, headers={"If-None-Match": etag})
+    second_test = client.getresponse().status == HTTPStatus.OK
+    client.close()
+
+    return first_test and second_test
+
+def test_keep_alive():
+    """Two requests on one connection are answered over the same socket."""
+
+    client.request("GET", "/")
+    response = client.getresponse()
+    response.read()
+    sock = client.sock
+
+    client.request("GET", "/")
+    body = client.getresponse().read()
+    same_socket = sock is not None and client.sock is sock
+    client.close()
+
+    return same_socket and body == EXPECTED_BODY
+
+
+def test_idle_connection_yields():
+    """A server that serves one connection at a time closes an idle kept alive connection when another one waits."""
+
+    server = servers.TCPServer((HOST, 0), HTTPHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    port = server.server_address[1]
+    try:
+        first = HTTPConnection(HOST, port, timeout=5)
+        first.request("GET", "/")
+        first.getresponse().read()
+
+        started = time.monotonic()
+        second = HTTPConnection(HOST, port, timeout=5)
+        second.request("GET", "/")
+        first_test = (second.getresponse().read() == EXPECTED_BODY
+                      and time.monotonic() - started < 1)
+        second.close()
+        second_test = first.sock.recv(1) == b""
+        first.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+    if not first_test:
+        print("failed first test")
+    if not second_test:
+        print("failed second test")
+
+    return first_test and second_test
+
 test_functions = [
     server_returns_valid_response_code,
     test_index,
@@ -445,18 +1666,52 @@ test_functions = [
     test_valid_content_length,
     test_content_type,
     test_valid_content_type,
+    test_gzip_content_encoding,
     test_nonexistent_resource_status_code,
     test_forbidden_resource_status_code,
     test_directory_traversal_exploit,
+    test_static_file,
+    test_metrics_endpoint,
     test_post_to_non_existing_file_should_create_file,
     test_post_to_test_file_should_return_file_content,
     test_post_to_test_file_should_return_correct_content_length,
+    test_get_range_of_test_file,
+    test_get_ranges_of_index,
+    test_post_chunked_to_test_file,
     RESTful_post_test,
     RESTful_post_and_get_test,
     RESTful_post_and_put_id_test,
     RESTful_post_invalid_delete_test,
     RESTful_post_delete_test,
-    RESTful_get_empty_test
+    RESTful_get_empty_test,
+    RESTful_delete_appends_to_log_test,
+    RESTful_conditional_get_test,
+    RESTful_paginated_get_test,
+    RESTful_store_full_test,
+    RESTful_braces_in_text_test,
+    RESTful_batch_test,
+    RESTful_mapped_store_test,
+    RESTful_old_log_test,
+    RESTful_torn_brace_test,
+    RESTful_versions_after_restart_test,
+    RESTful_get_one_test,
+    RESTful_response_cache_test,
+    RESTful_path_id_test,
+    RESTful_long_poll_test,
+    test_asyncio_body_too_large,
+    RESTful_long_poll_reads_ahead_test,
+    RESTful_blocking_slots_test,
+    test_slow_request_head,
+    test_threaded_server,
+    RESTful_prefork_store_test,
+    test_admission_refuses,
+    test_backlog_policy,
+    test_reload_hands_over,
+    test_draining_closes_connections,
+    RESTful_events_test,
+    test_asyncio_engine,
+    test_keep_alive,
+    test_idle_connection_yields
 ]
 
 
@@ -0,0 +1,464 @@
+import errno
+import mmap
+import os
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from message import loads
+
+try:
+    import fcntl
+except ImportError:    #not available on windows
+    fcntl = None
+
+"""
+Append-only log for the messages.
+
+Every change to the messages is one record appended to the log:
+
+    ,{"id": <id>,"text": <text>}    - create or replace message <id>
+    ,{"id": <id>}                   - delete message <id>
+    ,{"id": -1,"batch": <n>}        - the next n records are one batch
+    ,{"id": -2,"version": <v>}      - the records before are a snapshot at version <v>
+
+A batch is applied completely or not at all: if the log ends in the middle
+of one, the whole batch counts as a torn record. A messages file in the old
+format (only create records) is therefore a valid log. Replaying the log
+from the start gives the current messages, where the last record for an id
+wins. Once the log has grown past a size threshold, a background thread
+compacts it into a snapshot containing only the live messages, which is
+again a valid log.
+
+The version of a change is the position of the end of its record in the
+log, counted from the start of the log before any compaction: a snapshot
+ends with the version it was taken at, and the records after it keep their
+versions. So versions only grow, also over restarts, and are the same in
+every process sharing the log.
+"""
+
+fsync_policies = ("always", "batch", "interval")
+batch_id = -1
+mark_id = -2
+whitespace = (b" ", b"\t", b"\r", b"\n")
+
+
+def records(data, view:memoryview = None, spans:bool = False):
+    """
+    Yield (id, record, end) for every complete record in data, where record
+    is None for a delete and end is the offset just after the record. A torn
+    record at the end, from a crash in the middle of a write, is not yielded,
+    and neither are the records of a torn batch. For the snapshot mark,
+    record is its version. Whitespace after a record, which old messages
+    files have, is not part of it. The last record is only complete if it
+    is valid json. Anything else that can not be read is skipped, as
+    (None, None, end), so it is kept in the file.
+
+    data is bytes or an mmap. With a view of data, the records are slices of
+    the view instead of copies, with spans they are (offset, length) in data.
+    """
+
+    slicer = data if view is None else view
+    length = len(data)
+    pos = 0
+    batch = None        #records of the current batch, yielded when it is complete
+    while pos < length:
+        end = data.find(b',{"id": ', pos + 1)
+        last = end == -1
+        if last:
+            end = length
+        stop = end
+        while stop > pos and data[stop - 1:stop] in whitespace:
+            stop -= 1
+
+        id = None
+        if data[pos:pos + 8] == b',{"id": ' and data[stop - 1:stop] == b'}':
+            comma = data.find(b',', pos + 8, stop)
+            try:
+                id = int(data[pos + 8:stop - 1 if comma == -1 else comma])
+                if id < 0:
+                    value = int(data[comma + 1:stop - 1].partition(b':')[2])
+            except ValueError:
+                id = None
+
+            if id is not None and id >= 0 and comma != -1 and last:
+                #the text can end with a brace, so a write torn after one looks complete
+                try:
+                    loads(bytes(data[pos + 1:stop]))
+                except ValueError:
+                    return
+
+        if id is None:
+            if last and b',{"id": '.startswith(data[pos:pos + 8]):
+                return
+            pos = end
+            if batch is None:
+                yield None, None, end
+            continue
+
+        if id == mark_id:
+            pos = end
+            if batch is None:
+                yield id, value, end
+            continue
+
+        if comma == -1:
+            record = None
+        elif spans:
+            record = (pos + 1, stop - pos - 1)
+        else:
+            record = slicer[pos + 1:stop]
+        pos = end
+        if id == batch_id:
+            batch = []
+        elif batch is not None:
+            batch.append((id, record, end))
+        else:
+            yield id, record, end
+
+        if batch is not None and len(batch) == value:
+            yield from batch
+            batch = None
+
+
+def replay(data, messages:dict = None, view:memoryview = None, spans:bool = False,
+           versions:dict = None):
+    """
+    Apply the records in data to messages (a new dict if None) and return
+    the messages, the number of bytes that made up complete records, the
+    highest id in a record, also a deleted one (-1 if there are none), and
+    the version at the start of data. With versions, the version of every
+    message is put in it. data, view and spans are like for records().
+    """
+
+    if messages is None:
+        messages = {}
+
+    valid = 0
+    top = -1
+    base = 0
+    for id, record, valid in records(data, view, spans):
+        if id is None:
+            continue
+        if id == mark_id:
+            #the messages so far are a snapshot, their versions are not known
+            base = record - valid
+            if versions is not None:
+                versions.update(dict.fromkeys(messages, record))
+            continue
+
+        #a replaced message is moved to the end, like a delete and add
+        messages.pop(id, None)
+        if record is not None:
+            messages[id] = record
+            if versions is not None:
+                versions[id] = base + valid
+        top = max(top, id)
+
+    return messages, valid, top, base
+
+
+class MessageLog:
+    """
+    The file part of the message store. The caller is responsible for
+    holding locked() around every call, and must give a snapshot function
+    that returns all live messages as log records, for the compactor.
+
+    If shared is True, several processes can use the same log: locked()
+    then also takes an flock on path + ".lock", and read_tail() lets a
+    process catch up on the records the others appended.
+
+    fsync decides when appended records are forced to disk:
+    always   - after every record
+    batch    - after every batch records
+    interval - at most interval seconds after a record, by a background thread
+    """
+
+    def __init__(self, path:str, lock, snapshot, fsync:str = "interval",
+                 batch:int = 32, interval:float = 1.0, compact_at:int = 1 << 20,
+                 shared:bool = False):
+        if fsync not in fsync_policies:
+            raise ValueError("fsync must be one of " + ", ".join(fsync_policies))
+
+        self.path = path
+        self.lock = lock
+        self.snapshot = snapshot
+        self.fsync = fsync
+        self.batch = batch
+        self.interval = interval
+        self.compact_at = compact_at
+        self.next_compact = compact_at
+        self.shared = shared and fcntl is not None
+
+        self.fd = None
+        self.stat = None
+        self.size = 0
+        self.generation = 0     #counts the compactions, which move every record
+        self.base = 0           #version at the start of the file
+        self.unsynced = 0
+        self.wakeup = threading.Event()
+        self.worker = None
+        self.pid = None
+        self.lock_fd = None
+        self.lock_pid = None
+        self.depth = 0
+        self.compacting = threading.Lock()
+        self.compact_fd = None
+        self.compact_pid = None
+
+    @contextmanager
+    def locked(self):
+        """Hold the lock, and the file lock if the log is shared between processes."""
+
+        with self.lock:
+            if not self.shared:
+                yield
+                return
+
+            #flock belongs to the open file, so a forked child needs its own
+            if self.lock_pid != os.getpid():
+                self.lock_fd = os.open(self.path + ".lock", os.O_RDWR | os.O_CREAT, 0o644)
+                self.lock_pid = os.getpid()
+                self.depth = 0
+
+            if self.depth == 0:
+                fcntl.flock(self.lock_fd, fcntl.LOCK_EX)
+            self.depth += 1
+            try:
+                yield
+            finally:
+                self.depth -= 1
+                if self.depth == 0:
+                    fcntl.flock(self.lock_fd, fcntl.LOCK_UN)
+
+    def file_stat(self):
+        """Return what we use to recognize the file, or None if it is missing."""
+
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def changed(self):
+        """Return True if the file was changed by someone else since we last saw it."""
+
+        return self.file_stat() != self.stat
+
+    def read_tail(self):
+        """
+        Return the records appended by someone else since we last saw the
+        log, or None if the log was replaced or truncated and has to be
+        loaded again.
+        """
+
+        stat = self.file_stat()
+        if stat is None or self.stat is None or stat[0] != self.stat[0] or stat[1] < self.size:
+            return None
+
+        with open(self.path, "rb") as file:
+            file.seek(self.size)
+            data = file.read(stat[1] - self.size)
+
+        return data
+
+    def advance(self, valid:int, read:int):
+        """
+        Mark the first valid of the read bytes from read_tail() as applied.
+        The rest is a torn record from a writer that crashed, cut it away.
+        """
+
+        self.size += valid
+        if valid != read:
+            os.truncate(self.path, self.size)
+        self.stat = self.file_stat()
+
+    def load(self, mapped:bool = False, versions:dict = None):
+        """
+        Replay the whole log and return the messages in it and the highest id
+        used, and put the version of every message in versions. If mapped,
+        the log is mapped instead of read, and the messages are (offset,
+        length) of their records in the log.
+        """
+
+        self.close()
+        if mapped:
+            self.open()
+            data = self.map(os.fstat(self.fd).st_size)
+            messages, valid, top, self.base = replay(data, spans=True, versions=versions)
+        else:
+            try:
+                with open(self.path, "rb") as file:
+                    data = file.read(-1)
+            except OSError:
+                data = b""
+            messages, valid, top, self.base = replay(data, versions=versions)
+
+        #cut away a torn record at the end so new records are not appended to it
+        if valid != len(data):
+            with open(self.path, "r+b") as file:
+                file.truncate(valid)
+
+        self.size = valid
+        self.next_compact = max(self.compact_at, 2 * valid)
+        self.stat = self.file_stat()
+        return messages, top
+
+    def map(self, size:int = None):
+        """
+        Return a read-only mmap of the first size bytes of the log, by default
+        the ones applied so far. It stays valid when the log is compacted.
+        """
+
+        self.open()
+        size = self.size if size is None else size
+        if size == 0:
+            return b""
+        return mmap.mmap(self.fd, size, access=mmap.ACCESS_READ)
+
+    def open(self):
+        if self.fd is None:
+            self.fd = os.open(self.path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+
+    def close(self):
+        if self.fd is not None:
+            if self.unsynced:
+                os.fsync(self.fd)
+                self.unsynced = 0
+            os.close(self.fd)
+            self.fd = None
+
+    def append(self, record:bytes):
+        """Append one record to the log and force it to disk according to the fsync policy."""
+
+        self.open()
+        written = os.write(self.fd, record)
+        if written != len(record):
+            #the disk is full, do not leave a torn record behind
+            os.ftruncate(self.fd, self.size)
+            raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC), self.path)
+        self.size += len(record)
+        self.unsynced += 1
+
+        if self.fsync == "always" or (self.fsync == "batch" and self.unsynced >= self.batch):
+            self.flush()
+
+        st = os.fstat(self.fd)
+        self.stat = (st.st_ino, st.st_size, st.st_mtime_ns)
+
+        if self.fsync == "interval" or self.size >= self.next_compact:
+            self.start_worker()
+            self.wakeup.set()
+
+    def flush(self):
+        """Force every appended record to disk."""
+
+        if self.fd is not None and self.unsynced:
+            os.fsync(self.fd)
+            self.unsynced = 0
+
+    def start_worker(self):
+        """Start the background thread, again if we are a forked child or it died."""
+
+        if self.worker is None or self.pid != os.getpid() or not self.worker.is_alive():
+            self.pid = os.getpid()
+            self.worker = threading.Thread(target=self.work, daemon=True)
+            self.worker.start()
+
+    def work(self):
+        """Background thread doing interval fsyncs and compaction."""
+
+        while True:
+            self.wakeup.wait()
+            self.wakeup.clear()
+
+            #a failed fsync or compaction is tried again on the next wakeup
+            try:
+                if self.fsync == "interval":
+                    time.sleep(self.interval)
+                    with self.lock:
+                        self.flush()
+
+                if self.size >= self.next_compact:
+                    self.compact()
+            except Exception as error:
+                print("Message log %s: %s" % (self.path, error), file=sys.stderr)
+
+    def compact(self):
+        """
+        Replace the log with a snapshot of the live messages, unless another
+        thread or process is compacting it already. The snapshot is written
+        without holding the lock, then the records appended meanwhile are
+        copied over before the snapshot atomically replaces the log.
+        """
+
+        if not self.compacting.acquire(blocking=False):
+            return
+        try:
+            if self.shared:
+                if self.compact_pid != os.getpid():
+                    self.compact_fd = os.open(self.path + ".compact.lock",
+                                              os.O_RDWR | os.O_CREAT, 0o644)
+                    self.compact_pid = os.getpid()
+                try:
+                    fcntl.flock(self.compact_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return
+                try:
+                    self.write_snapshot()
+                finally:
+                    fcntl.flock(self.compact_fd, fcntl.LOCK_UN)
+            else:
+                self.write_snapshot()
+        finally:
+            self.compacting.release()
+
+    def write_snapshot(self):
+        with self.locked():
+            data = self.snapshot()
+            self.open()
+            offset = self.size
+            data += b',{"id": %d,"version": %d}' % (mark_id, self.base + offset)
+            mode = os.fstat(self.fd).st_mode & 0o777
+
+        #a name of its own, a compaction never writes into the file of another
+        fd, tmp = tempfile.mkstemp(".compact", os.path.basename(self.path) + ".",
+                                   os.path.dirname(self.path) or ".")
+        try:
+            self.replace_with(fd, tmp, mode, data, offset)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def replace_with(self, fd:int, tmp:str, mode:int, data:bytes, offset:int):
+        """Write the snapshot and the records after offset to tmp, then put it in place of the log."""
+
+        with open(fd, "wb") as file:
+            os.fchmod(fd, mode)
+            file.write(data)
+
+            with self.locked():
+                stat = self.file_stat()
+                if self.fd is None or stat is None or stat[0] != os.fstat(self.fd).st_ino:
+                    return      #replaced meanwhile, the snapshot is stale
+
+                #copy what was appended meanwhile, also by other processes
+                tail = os.pread(self.fd, stat[1] - offset, offset)
+                file.write(tail)
+                file.flush()
+                os.fsync(file.fileno())
+                os.replace(tmp, self.path)
+
+                self.unsynced = 0
+                os.close(self.fd)
+                self.fd = None
+                self.size = len(data) + self.size - offset
+                self.base += offset - len(data)
+                self.generation += 1
+                self.next_compact = max(self.compact_at, 2 * (len(data) + len(tail)))
+
+                #a size short of the file makes read_tail() pick up the rest
+                stat = self.file_stat()
+                self.stat = (stat[0], self.size, stat[2])